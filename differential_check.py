@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+differential_check.py: Randomized differential test of the optimized decoders.
+
+Every trial builds a random vocabulary, a Parser over random sentences and a model with random
+weights (a ParserModel or a StudentParserModel), then decodes random sentences twice:
+
+  * with a reference decoder: one sentence at a time, every configuration featurized by the
+    plain definition of the feature templates in `reference_features` and scored in float64
+    from the model's weights, taking the best legal transition;
+  * with every optimized engine: Parser.predict_dependencies over a range of batch sizes and
+    pipeline groups, with the long-sentence queue, with the parse cache, and with the NumPy
+    runtime (NumpyParserModel).
+
+Parser.extract_features and the batched forward pass are also checked against the reference
+on every configuration the reference visits. The first divergence is reported together with
+the trial seed, the engine settings and the parser configuration at which it happened.
+Decisions whose two best legal scores are closer than --tie-tolerance are near-ties that
+float32 rounding may legitimately break either way; a parse that diverges at a near-tie is
+counted but not reported as a failure.
+
+Usage:
+    python differential_check.py [--trials 20] [--seed 0] [--sentences 200] [--max-length 40]
+"""
+import sys
+import argparse
+
+import numpy as np
+import torch
+
+from parser_model import ParserModel, StudentParserModel
+from numpy_model import NumpyParserModel
+from parser_transitions import PartialParse
+from utils.parser_utils import Parser, ParseCache
+
+TRANSITIONS = ["LA", "RA", "S"]
+
+
+def random_dataset(rng, n_sentences, max_length, n_words=300, n_tags=12, n_labels=8):
+    """ Random sentences with random projective trees, as returned by read_conll.
+
+    Trees come from random legal arc-standard derivations, so every one is projective. Word
+    frequencies follow a Zipf-like distribution, so that some words are rare.
+    """
+    word_p = 1. / np.arange(1, n_words + 1)
+    word_p /= word_p.sum()
+    dataset = []
+    for _ in range(n_sentences):
+        n = int(rng.randint(1, max_length + 1))
+        head = [None] * (n + 1)
+        stack, buf = [0], list(range(1, n + 1))
+        while len(buf) > 0 or len(stack) > 1:
+            moves = (['S'] if len(buf) > 0 else []) + (['LA'] if len(stack) > 2 else []) + \
+                    (['RA'] if len(stack) > 1 and (len(buf) == 0 or len(stack) > 2) else [])
+            move = moves[rng.randint(len(moves))]
+            if move == 'S':
+                stack.append(buf.pop(0))
+            elif move == 'LA':
+                head[stack.pop(-2)] = stack[-1]
+            else:
+                dependent = stack.pop()
+                head[dependent] = stack[-1]
+        dataset.append({'word': ['w{}'.format(w) for w in rng.choice(n_words, n, p=word_p)],
+                        'pos': ['T{}'.format(t) for t in rng.randint(n_tags, size=n)],
+                        'head': head[1:],
+                        'label': ['root' if h == 0 else 'l{}'.format(rng.randint(n_labels)) for h in head[1:]]})
+    return dataset
+
+
+def reference_features(parser, stack, buf, arcs, ex):
+    """ Feature vector of a configuration, straight from the feature templates: the words and
+    tags of s3 s2 s1 b1 b2 b3, then for s1 and s2 those of lc1 rc1 lc2 rc2 lc1(lc1) rc1(rc1),
+    then the labels of those children.
+    """
+    stack = [0 if s == "ROOT" else s for s in stack]
+
+    def left_children(k):
+        return sorted(d for (h, d) in arcs if h == k and d < k)
+
+    def right_children(k):
+        return sorted((d for (h, d) in arcs if h == k and d > k), reverse=True)
+
+    def nth(items, n):
+        return items[n] if len(items) > n else None
+
+    positions = [stack[-j] if len(stack) >= j else None for j in (3, 2, 1)]
+    positions += [nth(buf, j) for j in range(3)]
+    child_positions = []
+    for j in (1, 2):
+        if len(stack) < j:
+            child_positions += [None] * 6
+            continue
+        lc, rc = left_children(stack[-j]), right_children(stack[-j])
+        llc = left_children(lc[0]) if len(lc) > 0 else []
+        rrc = right_children(rc[0]) if len(rc) > 0 else []
+        child_positions += [nth(lc, 0), nth(rc, 0), nth(lc, 1), nth(rc, 1), nth(llc, 0), nth(rrc, 0)]
+    positions += child_positions
+
+    features = [parser.NULL if p is None else ex['word'][p] for p in positions]
+    if parser.use_pos:
+        features += [parser.P_NULL if p is None else ex['pos'][p] for p in positions]
+    if parser.use_dep:
+        features += [parser.L_NULL if p is None else ex['label'][p] for p in child_positions]
+    return features
+
+
+class ReferenceScorer(object):
+    """ The model's logits computed in float64 from its state dict, one configuration at a time. """
+    def __init__(self, model):
+        state = {k: v.detach().cpu().double().numpy() for k, v in model.state_dict().items()
+                 if k != 'feature_idx'}
+        self.embeddings = state['embeddings']
+        self.w1, self.w2 = state['embed_to_hidden_weight'], state['hidden_to_logits_weight']
+        self.feature_idx = model.feature_idx.cpu().numpy() if hasattr(model, 'feature_idx') else None
+
+    def __call__(self, features):
+        x = np.asarray(features)
+        if self.feature_idx is not None:
+            x = x[self.feature_idx]
+        h = np.maximum(self.embeddings[x].reshape(-1) @ self.w1[:-1] + self.w1[-1], 0)
+        return h @ self.w2[:-1] + self.w2[-1]
+
+
+def reference_decode(parser, scorer, ex):
+    """ Greedily parses one vectorized example.
+
+    @return trace (list of dict): per step, the configuration (stack, buffer, arcs), its
+                                  reference features, legal mask, scores, transition taken and
+                                  the margin between the two best legal scores
+    @return dependencies (list of tuple): the (head, dependent) arcs in creation order
+    """
+    pp = PartialParse(list(range(1, len(ex['word']))))
+    pp.stack[0] = 0
+    trace = []
+    while len(pp.buffer) > 0 or len(pp.stack) > 1:
+        legal = parser.legal_labels(pp.stack, pp.buffer)
+        features = reference_features(parser, pp.stack, pp.buffer, pp.dependencies, ex)
+        scores = scorer(features)
+        legal_scores = sorted((scores[t] for t in range(len(legal)) if legal[t]), reverse=True)
+        best = max((t for t in range(len(legal)) if legal[t]), key=lambda t: scores[t])
+        trace.append({'stack': list(pp.stack), 'buffer': list(pp.buffer), 'arcs': list(pp.dependencies),
+                      'features': features, 'legal': legal, 'scores': scores, 'transition': TRANSITIONS[best],
+                      'margin': legal_scores[0] - legal_scores[1] if len(legal_scores) > 1 else float('inf')})
+        pp.parse_step(TRANSITIONS[best])
+    return trace, pp.dependencies
+
+
+def engines(n_sentences):
+    """ Settings of the optimized decoders compared with the reference: (name, parser attributes,
+    whether to use the NumPy runtime, batch size). """
+    for batch_size in sorted({1, 7, 64, n_sentences}):
+        for groups in (1, 2, 3):
+            yield 'batch={} groups={}'.format(batch_size, groups), {'pipeline_groups': groups}, False, batch_size
+    yield 'long queue', {'long_sentence_threshold': 10, 'long_sentence_batch_size': 5}, False, 64
+    yield 'parse cache', {'parse_cache': ParseCache(n_sentences)}, False, 64
+    for batch_size in (1, 64):
+        yield 'numpy batch={}'.format(batch_size), {}, True, batch_size
+
+
+def describe(step):
+    return "stack {} buffer {} arcs {}".format(step['stack'], step['buffer'][:6], step['arcs'])
+
+
+class Report(object):
+    def __init__(self):
+        self.checks = 0
+        self.near_ties = 0
+        self.failure = None
+
+    def fail(self, message):
+        if self.failure is None:
+            self.failure = message
+
+
+def check_trial(seed, n_sentences, max_length, tie_tolerance, atol, report):
+    """ Runs one trial; returns False at the first divergence (recorded in `report`). """
+    rng = np.random.RandomState(seed)
+    train = random_dataset(rng, 200, max_length)
+    parser = Parser(train)
+    embed_size = int(rng.choice([8, 16, 50]))
+    embeddings = rng.normal(0, 1, (parser.n_tokens, embed_size)).astype(np.float32)
+    hidden_size = int(rng.choice([16, 64, 200]))
+    if seed % 2 == 0:
+        model = ParserModel(embeddings, n_features=parser.n_features, hidden_size=hidden_size, seed=seed)
+        kind = 'ParserModel'
+    else:
+        feature_idx = sorted(rng.choice(parser.n_features, int(rng.randint(6, parser.n_features)), replace=False))
+        model = StudentParserModel(embeddings, [int(i) for i in feature_idx], hidden_size=hidden_size, seed=seed)
+        kind = 'StudentParserModel ({} features)'.format(len(feature_idx))
+    model.eval()
+    parser.model = model
+    setting = "trial seed {}: {}, embed {}, hidden {}".format(seed, kind, embed_size, hidden_size)
+
+    # Sentences partly share words with the training data (and so hit UNK), and repeat, so
+    # the parse cache has hits.
+    data = random_dataset(rng, n_sentences, max_length)
+    data += [data[i] for i in rng.randint(len(data), size=max(1, n_sentences // 10))]
+    dataset = parser.vectorize(data)
+    scorer = ReferenceScorer(model)
+
+    traces, expected = [], []
+    for ex in dataset:
+        trace, deps = reference_decode(parser, scorer, ex)
+        traces.append(trace)
+        expected.append(deps)
+
+    # Features and logits of every configuration the reference visited.
+    steps = [(i, j, step) for i, trace in enumerate(traces) for j, step in enumerate(trace)]
+    for i, j, step in steps:
+        report.checks += 1
+        got = parser.extract_features(list(step['stack']), step['buffer'], step['arcs'], dataset[i])
+        if got != step['features']:
+            col = next(c for c in range(len(got)) if got[c] != step['features'][c])
+            report.fail("{}\nextract_features differs from the reference at sentence {} step {}, feature {}: "
+                        "expected {} got {}\n  {}".format(setting, i, j, col, step['features'][col], got[col],
+                                                          describe(step)))
+            return False
+    x = torch.tensor([step['features'] for (_, _, step) in steps], dtype=torch.long)
+    with torch.no_grad():
+        logits = model(x).double().numpy()
+    for (i, j, step), row in zip(steps, logits):
+        if np.abs(row - step['scores']).max() > atol:
+            report.fail("{}\nParserModel.forward differs from the reference at sentence {} step {}: "
+                        "expected {} got {}\n  {}".format(setting, i, j, step['scores'], row, describe(step)))
+            return False
+
+    # Whole parses with every optimized engine.
+    for name, settings, use_numpy, batch_size in engines(len(dataset)):
+        engine_parser = Parser.__new__(Parser)
+        engine_parser.__dict__.update(parser.__dict__)
+        engine_parser.__dict__.update(settings)
+        if use_numpy:
+            state = {k: v.detach().numpy() for k, v in model.state_dict().items()}
+            engine_parser.model = NumpyParserModel(state['embeddings'], state['embed_to_hidden_weight'],
+                                                   state['hidden_to_logits_weight'], state.get('feature_idx'))
+        got = engine_parser.predict_dependencies(dataset, batch_size)
+        for i, (deps, ref) in enumerate(zip(got, expected)):
+            report.checks += 1
+            if list(deps) == list(ref):
+                continue
+            k = next((k for k in range(min(len(deps), len(ref))) if deps[k] != ref[k]), min(len(deps), len(ref)))
+            # The reference step that created the first differing arc.
+            j = [n for n, step in enumerate(traces[i]) if step['transition'] != 'S'][k] \
+                if k < len(ref) else len(traces[i]) - 1
+            step = traces[i][j]
+            if min(s['margin'] for s in traces[i][:j + 1]) < tie_tolerance:
+                report.near_ties += 1
+                continue
+            report.fail("{}\nengine '{}' differs from the reference on sentence {} ({} words): first differing "
+                        "arc #{}: expected {} got {}\n  at reference step {} ({}, scores {}, legal {})\n  {}".format(
+                            setting, name, i, len(ref), k, ref[k] if k < len(ref) else None,
+                            deps[k] if k < len(deps) else None, j, step['transition'],
+                            np.round(step['scores'], 6).tolist(), step['legal'], describe(step)))
+            return False
+    return True
+
+
+def main(args):
+    report = Report()
+    for trial in range(args.trials):
+        seed = args.seed + trial
+        if not check_trial(seed, args.sentences, args.max_length, args.tie_tolerance, args.atol, report):
+            print("FAILED after {} checks".format(report.checks))
+            print(report.failure)
+            return 1
+        print("trial {} (seed {}) passed".format(trial + 1, seed))
+    print("All {} trials passed: {} checks, {} parses diverging only at near-ties".format(
+        args.trials, report.checks, report.near_ties))
+    return 0
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Randomized differential test of the optimized decoders')
+    argparser.add_argument('--trials', type=int, default=20, help='number of random parser/model pairs')
+    argparser.add_argument('--seed', type=int, default=0, help='seed of the first trial')
+    argparser.add_argument('--sentences', type=int, default=200, help='random sentences decoded per trial')
+    argparser.add_argument('--max-length', type=int, default=40, help='maximum sentence length')
+    argparser.add_argument('--tie-tolerance', type=float, default=1e-4,
+                           help='score margin under which a decision counts as a near-tie')
+    argparser.add_argument('--atol', type=float, default=1e-3,
+                           help='tolerance between float32 logits and the float64 reference')
+    sys.exit(main(argparser.parse_args()))
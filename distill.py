@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+distill.py: Distill a trained ParserModel into a smaller, faster student.
+
+The student (StudentParserModel) uses a subset of the parser features and smaller embedding
+and hidden dimensions. It is trained on the configurations produced by `create_instances`
+against the temperature-softened logits of the teacher, mixed with the usual gold-transition
+loss, and the speed/accuracy trade-off against the teacher is reported on the dev set.
+
+The teacher is loaded from its run directory together with its vocabularies, and the data is
+vectorized with them. The student is written as a run directory of its own (parser.pkl and
+model.weights), so it can be used by `run.py eval`, `run.py parse` and `run.py export-numpy`.
+
+Usage:
+    python distill.py --teacher results/<run>/ [--embed-size 25] [--hidden-size 100]
+"""
+from datetime import datetime
+import os
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from parser_model import StudentParserModel
+from utils.parser_utils import Config, DTYPES, PinnedBuffers, minibatches, read_conll, load_parser, save_parser, \
+    AverageMeter, to_device, torch_dtype
+
+# Word features of Parser.extract_features, per block of 18 (words, then POS tags):
+#   0-5: s3 s2 s1 b1 b2 b3, 6-11: lc1 rc1 lc2 rc2 llc1 rrc1 of s1, 12-17: same for s2
+FEATURE_SETS = {
+    'full': list(range(18)),
+    'compact': list(range(6)) + [6, 7, 12, 13],
+    'minimal': list(range(6)),
+}
+
+
+def feature_subset(name, n_features=36):
+    """ Expands a named word-feature selection to column indices of the full feature vector,
+    keeping the matching POS (and label) columns.
+    """
+    block = FEATURE_SETS[name]
+    return [b + offset for offset in range(0, n_features, 18) for b in block if b + offset < n_features]
+
+
+def project_embeddings(embeddings, embed_size):
+    """ Projects the teacher's embedding table onto its top `embed_size` principal directions. """
+    if embed_size >= embeddings.shape[1]:
+        return embeddings.copy()
+    _, _, vt = np.linalg.svd(embeddings - embeddings.mean(0), full_matrices=False)
+    return (embeddings @ vt[:embed_size].T).astype('float32')
+
+
+def load_data(parser, reduced=True):
+    """ Reads the training and dev sets and vectorizes them with the teacher's vocabularies.
+
+    @return train_data, dev_data (list, list): training instances from `create_instances`
+                                               and vectorized dev examples
+    """
+    config = Config()
+    train_set = read_conll(os.path.join(config.data_path, config.train_file), lowercase=config.lowercase,
+                           max_example=1000 if reduced else None)
+    dev_set = read_conll(os.path.join(config.data_path, config.dev_file), lowercase=config.lowercase,
+                         max_example=500 if reduced else None)
+    return parser.create_instances(parser.vectorize(train_set)), parser.vectorize(dev_set)
+
+
+def distill(parser, teacher, student, train_data, output_path, batch_size=1024, n_epochs=10, lr=0.0005,
+            temperature=2.0, alpha=0.5):
+    """ Train `student` to match the logits of `teacher`.
+
+    @param parser (Parser): Neural Dependency Parser
+    @param teacher (ParserModel): trained teacher model
+    @param student (StudentParserModel): model being trained
+    @param train_data (list): training instances from `create_instances`
+    @param output_path (str): Path to which the student weights are written
+    @param batch_size (int): Number of examples in a single batch
+    @param n_epochs (int): Number of training epochs
+    @param lr (float): Learning rate
+    @param temperature (float): Softmax temperature applied to both teacher and student logits
+    @param alpha (float): Weight of the distillation loss; the gold-transition loss gets 1 - alpha
+    """
+    optimizer = torch.optim.Adam(student.parameters(), lr)
+    teacher.eval()
+    buffers = PinnedBuffers()
+
+    for epoch in range(n_epochs):
+        print("Epoch {:} out of {:}".format(epoch + 1, n_epochs))
+        student.train()
+        loss_meter = AverageMeter()
+        for train_x, train_y in minibatches(train_data, batch_size):
+            optimizer.zero_grad()
+            train_x = to_device(torch.from_numpy(train_x).long(), student.device, buffers)
+            train_y = to_device(torch.from_numpy(train_y.nonzero()[1]), student.device, buffers)
+            with torch.no_grad():
+                teacher_logits = teacher(train_x)
+            logits = student(train_x)
+            soft_loss = F.kl_div(F.log_softmax(logits / temperature, dim=1),
+                                 F.softmax(teacher_logits / temperature, dim=1),
+                                 reduction='batchmean') * temperature ** 2
+            hard_loss = F.cross_entropy(logits, train_y)
+            loss = alpha * soft_loss + (1 - alpha) * hard_loss
+            loss.backward()
+            optimizer.step()
+            loss_meter.update(loss.item())
+        print("Average Distillation Loss: {}".format(loss_meter.avg))
+        print("")
+
+    torch.save(student.state_dict(), output_path)
+
+
+def benchmark(parser, model, dataset):
+    """ Parses `dataset` with `model` and returns (UAS, sentences per second, parameter count). """
+    parser.model = model
+    model.eval()
+    start = time.time()
+    with torch.no_grad():
+        UAS, _ = parser.parse(dataset)
+    elapsed = time.time() - start
+    n_params = sum(p.numel() for p in model.parameters())
+    return UAS, len(dataset) / elapsed, n_params
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Distill a trained parser into a smaller student')
+    argparser.add_argument('-d', '--debug', action='store_true', help='whether to enter debug mode')
+    argparser.add_argument('--teacher', required=True,
+                           help='run directory of the teacher (parser.pkl and model.weights written by run.py)')
+    argparser.add_argument('--features', choices=sorted(FEATURE_SETS), default='compact',
+                           help='feature subset used by the student')
+    argparser.add_argument('--embed-size', type=int, default=25, help='student embedding size')
+    argparser.add_argument('--hidden-size', type=int, default=100, help='student hidden units')
+    argparser.add_argument('--temperature', type=float, default=2.0, help='distillation temperature')
+    argparser.add_argument('--alpha', type=float, default=0.5, help='weight of the distillation loss')
+    argparser.add_argument('--n-epochs', type=int, default=10, help='number of training epochs')
+    argparser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+                           help='device to train on (default: cuda if available, else cpu)')
+    argparser.add_argument('--dtype', choices=DTYPES, default='float32',
+                           help='floating point type of the teacher and student parameters')
+    args = argparser.parse_args()
+    # A directory written by `run.py export-numpy` has .npy arrays instead of model.weights;
+    # its NumpyParserModel cannot be run on torch tensors or trained against.
+    if not os.path.exists(os.path.join(args.teacher, 'model.weights')):
+        argparser.error("--teacher must be a torch run directory with parser.pkl and model.weights "
+                        "(not a `run.py export-numpy` directory): {}".format(args.teacher))
+
+    print(80 * "=")
+    print("INITIALIZING")
+    print(80 * "=")
+    dtype = torch_dtype(args.dtype)
+    parser = load_parser(os.path.join(args.teacher, 'parser.pkl'), os.path.join(args.teacher, 'model.weights'),
+                         device=args.device, dtype=dtype)
+    teacher = parser.model
+    train_data, dev_data = load_data(parser, reduced=args.debug)
+    student_embeddings = project_embeddings(teacher.embeddings.detach().cpu().float().numpy(), args.embed_size)
+    student = StudentParserModel(student_embeddings, feature_subset(args.features, parser.n_features),
+                                 hidden_size=args.hidden_size, device=args.device, dtype=dtype)
+
+    print(80 * "=")
+    print("DISTILLING")
+    print(80 * "=")
+    output_dir = "results/{:%Y%m%d_%H%M%S}/".format(datetime.now())
+    output_path = output_dir + "model.weights"
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    save_parser(parser, output_dir + "parser.pkl")
+    distill(parser, teacher, student, train_data, output_path, batch_size=50, n_epochs=args.n_epochs,
+            lr=0.0005, temperature=args.temperature, alpha=args.alpha)
+
+    print(80 * "=")
+    print("SPEED / ACCURACY")
+    print(80 * "=")
+    print("{:<10} {:>8} {:>12} {:>12}".format("model", "dev UAS", "sents/sec", "params"))
+    for name, model in (("teacher", teacher), ("student", student)):
+        UAS, speed, n_params = benchmark(parser, model, dev_data)
+        print("{:<10} {:>8.2f} {:>12.1f} {:>12d}".format(name, UAS * 100.0, speed, n_params))
+    print("Student saved to {} (parser.pkl, model.weights)".format(output_dir))
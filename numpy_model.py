@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+numpy_model.py: Inference-only ParserModel running on NumPy arrays.
+
+Decoding needs nothing from PyTorch but an embedding lookup, two matrix products and a ReLU.
+NumpyParserModel computes the same logits as ParserModel / StudentParserModel from the arrays
+written by `utils.parser_utils.export_numpy_model`, so parse workers can run without importing
+torch. The arrays are memory-mapped read-only by default: pages are loaded on first use and,
+being backed by the files, are shared by every process on the machine that maps them.
+"""
+import os
+
+import numpy as np
+
+WEIGHT_NAMES = ('embeddings', 'embed_to_hidden_weight', 'hidden_to_logits_weight')
+
+
+class NumpyParserModel(object):
+    """ Feedforward parser network of ParserModel, for inference only.
+
+    @param embeddings (ndarray): embedding table (num_words, embed_size)
+    @param embed_to_hidden_weight (ndarray): hidden layer weights, bias in the last row
+                                             (n_features * embed_size + 1, hidden_size)
+    @param hidden_to_logits_weight (ndarray): output layer weights, bias in the last row
+                                              (hidden_size + 1, n_classes)
+    @param feature_idx (ndarray): columns of the full feature matrix the model reads (student
+                                  models), or None for all of them
+    """
+    def __init__(self, embeddings, embed_to_hidden_weight, hidden_to_logits_weight, feature_idx=None):
+        self.embeddings = embeddings
+        self.embed_to_hidden_weight = embed_to_hidden_weight
+        self.hidden_to_logits_weight = hidden_to_logits_weight
+        self.feature_idx = feature_idx
+        self.embed_size = embeddings.shape[1]
+        self.hidden_size = embed_to_hidden_weight.shape[1]
+        self.n_classes = hidden_to_logits_weight.shape[1]
+        self.n_features = (embed_to_hidden_weight.shape[0] - 1) // self.embed_size
+
+    @classmethod
+    def load(cls, model_dir, mmap=True):
+        """ Loads the arrays written by export_numpy_model from `model_dir`.
+
+        @param mmap (bool): memory-map the arrays read-only instead of reading them into memory
+        """
+        mode = 'r' if mmap else None
+        arrays = [np.load(os.path.join(model_dir, name + '.npy'), mmap_mode=mode) for name in WEIGHT_NAMES]
+        idx_path = os.path.join(model_dir, 'feature_idx.npy')
+        feature_idx = np.load(idx_path) if os.path.exists(idx_path) else None
+        return cls(*arrays, feature_idx=feature_idx)
+
+    def parameters(self):
+        return [self.embeddings, self.embed_to_hidden_weight, self.hidden_to_logits_weight]
+
+    def eval(self):
+        return self
+
+    def forward(self, w):
+        """ Computes the logits of ParserModel.forward.
+
+        @param w (ndarray): token ids of all parser features (batch_size, total_features)
+
+        @return logits (ndarray): (batch_size, n_classes)
+        """
+        if self.feature_idx is not None:
+            w = w[:, self.feature_idx]
+        x = self.embeddings[w.reshape(-1)].reshape(w.shape[0], -1)
+        h = x @ self.embed_to_hidden_weight[:-1]
+        h += self.embed_to_hidden_weight[-1]
+        np.maximum(h, 0, out=h)
+        logits = h @ self.hidden_to_logits_weight[:-1]
+        logits += self.hidden_to_logits_weight[-1]
+        return logits
+
+    __call__ = forward
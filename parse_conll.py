@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+parse_conll.py: Parse a CoNLL(-U) or tagged-text file with a trained parser and write CoNLL-U.
+
+The input is streamed in chunks of `--chunk-size` sentences. Within a chunk, sentences are
+parsed sorted by length so that each decoding minibatch holds sentences that finish at about
+the same time, and are written back in input order through a buffered writer. Only one chunk
+is held in memory at a time.
+
+With `--shard I/K`, only the I-th of K contiguous, equally sized parts of the input is read
+and parsed (located through the byte-offset index of utils/conll_index.py, stored next to the
+input), so K workers can split a large file without each of them scanning it.
+
+With a model directory written by `run.py export-numpy`, parsing runs on the NumPy runtime
+(numpy_model.py) and torch is never imported.
+
+Usage:
+    python parse_conll.py results/<run>/ input.conll output.conllu [--tagged]
+    python run.py parse results/<run>/ input.conll output.conllu [--tagged]
+"""
+import sys
+import time
+import argparse
+from itertools import islice
+
+from utils.parser_utils import Config, DTYPES, ParseCache, iter_conll, write_conll, load_model_dir, torch_dtype
+
+
+def parse_file(parser, in_file, out_file, chunk_size=10000, batch_size=5000, tagged=False,
+               buffer_size=1 << 20):
+    """ Parses `in_file` chunk by chunk and writes the result to `out_file`.
+
+    @param parser (Parser): parser with a loaded model
+    @param in_file (file): open input file (CoNLL or, with `tagged`, one `word/TAG` sentence per line)
+    @param out_file (str): path of the CoNLL-U output
+    @param chunk_size (int): number of sentences read, parsed and written at a time
+    @param batch_size (int): number of PartialParses per decoding minibatch
+    @param tagged (bool): whether the input is tagged text rather than CoNLL
+    @param buffer_size (int): size in bytes of the output write buffer
+
+    @return n_sentences, n_tokens (int, int): amount of text parsed
+    """
+    config = Config()
+    sentences = iter_conll(in_file, lowercase=config.lowercase, tagged=tagged)
+    n_sentences = n_tokens = 0
+    with open(out_file, 'w', buffering=buffer_size) as f:
+        while True:
+            chunk = list(islice(sentences, chunk_size))
+            if len(chunk) == 0:
+                break
+            order = sorted(range(len(chunk)), key=lambda i: len(chunk[i][0]['word']))
+            examples = parser.vectorize([chunk[i][0] for i in order])
+            dependencies = [None] * len(chunk)
+            for i, deps in zip(order, parser.predict_dependencies(examples, batch_size)):
+                dependencies[i] = deps
+            for (ex, lines), deps in zip(chunk, dependencies):
+                write_conll(f, ex, lines, deps, tagged=tagged)
+                n_tokens += len(ex['word'])
+            n_sentences += len(chunk)
+    return n_sentences, n_tokens
+
+
+def add_arguments(argparser):
+    """ Adds the command-line arguments of `main` to `argparser` (shared with `run.py parse`). """
+    argparser.add_argument('model_dir', help='directory with parser.pkl and model.weights written by run.py, '
+                                             'or with the .npy arrays written by `run.py export-numpy`')
+    argparser.add_argument('input', help="input file, or '-' for stdin")
+    argparser.add_argument('output', help='output CoNLL-U file')
+    argparser.add_argument('--tagged', action='store_true',
+                           help='input is one sentence per line of word/TAG tokens instead of CoNLL')
+    argparser.add_argument('--chunk-size', type=int, default=10000, help='sentences held in memory at a time')
+    argparser.add_argument('--batch-size', type=int, default=5000, help='parses per decoding minibatch')
+    argparser.add_argument('--pipeline-groups', type=int, default=2,
+                           help='decode in this many thread-pipelined groups (1 disables pipelining)')
+    argparser.add_argument('--long-threshold', type=int, default=None,
+                           help='decode sentences longer than this many tokens in a separate queue')
+    argparser.add_argument('--long-time-budget', type=float, default=None,
+                           help='seconds of decoding per long sentence before falling back to right-branching')
+    argparser.add_argument('--long-max-steps', type=int, default=None,
+                           help='transitions per long sentence before falling back to right-branching')
+    argparser.add_argument('--device', default='cpu', help='device to run the model on')
+    argparser.add_argument('--dtype', choices=DTYPES, default=None,
+                           help='floating point type to run the model in (default: that of model.weights)')
+    argparser.add_argument('--cache-size', type=int, default=0,
+                           help='cache the parses of up to this many distinct sentences, so repeated sentences '
+                                'are parsed once (0 disables the cache)')
+    argparser.add_argument('--shard', metavar='I/K', default=None,
+                           help='parse only the I-th (0-based) of K contiguous shards of the input, located '
+                                'through its sentence index (CoNLL files only; see utils/conll_index.py)')
+    argparser.add_argument('--mmap', action='store_true',
+                           help='memory-map model.weights read-only so that parse processes on a machine '
+                                'share one copy of the weights (cpu only)')
+
+
+def check_arguments(argparser, args):
+    """ Rejects combinations of the arguments of `main` before anything is loaded. """
+    if args.shard is not None and (args.tagged or args.input == '-'):
+        argparser.error("--shard needs a CoNLL input file")
+    if args.mmap and args.dtype is not None:
+        argparser.error("--mmap uses model.weights in the floating point type it was saved in; "
+                        "drop --dtype or --mmap")
+
+
+def main(args):
+    parser = load_model_dir(args.model_dir, device=args.device, mmap=args.mmap, dtype=torch_dtype(args.dtype))
+    parser.pipeline_groups = args.pipeline_groups
+    parser.long_sentence_threshold = args.long_threshold
+    parser.long_sentence_time_budget = args.long_time_budget
+    parser.long_sentence_max_steps = args.long_max_steps
+    parser.parse_cache = ParseCache(args.cache_size) if args.cache_size > 0 else None
+
+    start = time.time()
+    if args.shard is not None:
+        from utils.conll_index import ConllIndex
+        i, k = (int(x) for x in args.shard.split('/'))
+        index = ConllIndex(args.input)
+        shard_start, shard_end = index.shards(k)[i]
+        in_file = index.lines(shard_start, shard_end)
+    else:
+        in_file = sys.stdin if args.input == '-' else open(args.input)
+    try:
+        n_sentences, n_tokens = parse_file(parser, in_file, args.output, chunk_size=args.chunk_size,
+                                           batch_size=args.batch_size, tagged=args.tagged)
+    finally:
+        if in_file is not sys.stdin:
+            in_file.close()
+    elapsed = time.time() - start
+    print("Parsed {} sentences ({} tokens) in {:.2f} seconds ({:.0f} tokens/sec)".format(
+        n_sentences, n_tokens, elapsed, n_tokens / max(elapsed, 1e-9)), file=sys.stderr)
+    if parser.parse_cache is not None:
+        stats = parser.parse_cache.stats()
+        print("Parse cache: {} entries, {} hits, {} misses ({:.1%} hit rate), {} misses answered by a repeat "
+              "in the same chunk, {} evictions".format(stats['size'], stats['hits'], stats['misses'], stats['hit_rate'],
+                                                       stats['deduplicated'], stats['evictions']), file=sys.stderr)
+    if args.long_threshold is not None:
+        stats = parser.decode_stats
+        print("Long sentences: {} ({:.2f} seconds), completed right-branching: {}".format(
+            stats['long_sentences'], stats['long_seconds'], stats['fallbacks']), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='Parse a CoNLL or tagged-text file to CoNLL-U')
+    add_arguments(argparser)
+    args = argparser.parse_args()
+    check_arguments(argparser, args)
+    main(args)
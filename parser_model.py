@@ -34,24 +34,24 @@ class ParserModel(nn.Module):
         - For further documentation on "nn.Module" please see https://pytorch.org/docs/stable/nn.html.
     """
     def __init__(self, embeddings, n_features=36,
-        hidden_size=200, n_classes=3):
+        hidden_size=200, n_classes=3, seed=None, device='cpu', dtype=torch.float32):
         """ Initialize the parser model.
 
         @param embeddings (ndarray): word embeddings (num_words, embedding_size)
         @param n_features (int): number of input features
         @param hidden_size (int): number of hidden units
         @param n_classes (int): number of output classes
+        @param seed (int): if given, weights are initialized from this seed without touching
+                           the global torch RNG; otherwise the global RNG is used
+        @param device (str or torch.device): device holding the parameters; inputs are moved to it
+        @param dtype (torch.dtype): floating point type of the parameters
         """
-        if torch.cuda.is_available():
-            print('GPU Available!!!')
-            torch.set_default_tensor_type(torch.cuda.FloatTensor)
-
         super(ParserModel, self).__init__()
         self.n_features = n_features
         self.n_classes = n_classes
         self.embed_size = embeddings.shape[1]
         self.hidden_size = hidden_size
-        self.embeddings = nn.Parameter(torch.tensor(embeddings))
+        self.embeddings = nn.Parameter(torch.tensor(embeddings, dtype=dtype, device=device))
 
         # Note: Trainable variables are declared as `nn.Parameter` which is a commonly used API
         #   to include a tensor into a computational graph to support updating w.r.t its gradient.
@@ -65,18 +65,29 @@ class ParserModel(nn.Module):
         #   nn.Parameter: https://pytorch.org/docs/stable/generated/torch.nn.parameter.Parameter.html
         #   Initialization: https://pytorch.org/docs/stable/nn.init.html
 
-        # create a parameter matrix (weights and bias) for the hidden layer
-        embed_to_hidden = torch.empty(self.n_features * self.embed_size + 1, self.hidden_size)
-        # initialize parameters with the `nn.init.xavier_uniform_` function with default parameters
-        nn.init.xavier_uniform_(embed_to_hidden)
-        # declare `self.embed_to_hidden_weight` as `nn.Parameter` with this as its data
-        self.embed_to_hidden_weight = nn.Parameter(embed_to_hidden)
-        # create a parameter matrix (weights and bias) for the output layer
-        hidden_to_logits = torch.empty(self.hidden_size + 1, self.n_classes)
-        # initialize parameters with the `nn.init.xavier_uniform_` function with default parameters
-        nn.init.xavier_uniform_(hidden_to_logits)
-        # declare `self.hidden_to_logits_weight` as `nn.Parameter` with this as its data
-        self.hidden_to_logits_weight = nn.Parameter(hidden_to_logits)
+        with torch.random.fork_rng(enabled=seed is not None):
+            if seed is not None:
+                torch.manual_seed(seed)
+            # create a parameter matrix (weights and bias) for the hidden layer
+            embed_to_hidden = torch.empty(self.n_features * self.embed_size + 1, self.hidden_size, dtype=dtype)
+            # initialize parameters with the `nn.init.xavier_uniform_` function with default parameters
+            nn.init.xavier_uniform_(embed_to_hidden)
+            # declare `self.embed_to_hidden_weight` as `nn.Parameter` with this as its data
+            self.embed_to_hidden_weight = nn.Parameter(embed_to_hidden.to(device))
+            # create a parameter matrix (weights and bias) for the output layer
+            hidden_to_logits = torch.empty(self.hidden_size + 1, self.n_classes, dtype=dtype)
+            # initialize parameters with the `nn.init.xavier_uniform_` function with default parameters
+            nn.init.xavier_uniform_(hidden_to_logits)
+            # declare `self.hidden_to_logits_weight` as `nn.Parameter` with this as its data
+            self.hidden_to_logits_weight = nn.Parameter(hidden_to_logits.to(device))
+
+    @property
+    def device(self):
+        return self.embeddings.device
+
+    @property
+    def dtype(self):
+        return self.embeddings.dtype
 
     def embedding_lookup(self, w):
         """ Utilize `w` to select embeddings from embedding matrix `self.embeddings`
@@ -101,10 +112,7 @@ class ParserModel(nn.Module):
         ###       (we are asking you to implement that!). Pay attention to tensor shapes
         ###       and reshape if necessary. Make sure you know each tensor's shape before you run the code!
         w_initial_shape = w.shape
-        if torch.cuda.is_available():
-            w = w.view(-1).to('cuda')
-        else:
-            w = w.view(-1)
+        w = w.reshape(-1).to(self.embeddings.device, non_blocking=True)
         x = self.embeddings.index_select(0, w)
         x = x.view(w_initial_shape[0],  w_initial_shape[1] * self.embed_size)
 
@@ -151,11 +159,11 @@ class ParserModel(nn.Module):
         ### 4. Multiply this by the hidden layer weights to get logits
 
         x = self.embedding_lookup(w)
-        x_with_one_at_end = torch.cat((x, torch.ones(x.shape[0], 1)), dim=1)
+        x_with_one_at_end = torch.cat((x, x.new_ones(x.shape[0], 1)), dim=1)
         embedding_vector_and_input_weights = x_with_one_at_end@self.embed_to_hidden_weight
         m = nn.ReLU()
         h = m(embedding_vector_and_input_weights)
-        h_with_one_at_end = torch.cat((h, torch.ones(h.shape[0], 1)), dim=1)
+        h_with_one_at_end = torch.cat((h, h.new_ones(h.shape[0], 1)), dim=1)
         logits = h_with_one_at_end@self.hidden_to_logits_weight
 
         ### END YOUR CODE
@@ -194,6 +202,38 @@ class ParserModel(nn.Module):
         return passed
 
 
+class StudentParserModel(ParserModel):
+    """ A smaller ParserModel that reads only a subset of the parser's feature columns.
+
+    It is trained by distill.py against the logits of a full ParserModel. forward still takes
+    the full (batch_size, n_features) matrix produced by Parser.extract_features and narrows it
+    to `feature_idx` itself, so the student is a drop-in replacement for `parser.model`.
+    """
+    def __init__(self, embeddings, feature_idx, hidden_size=200, n_classes=3, seed=None,
+                 device='cpu', dtype=torch.float32):
+        """ Initialize the student model.
+
+        @param embeddings (ndarray): word embeddings (num_words, embedding_size)
+        @param feature_idx (list of int): columns of the full feature vector the student uses
+        @param hidden_size (int): number of hidden units
+        @param n_classes (int): number of output classes
+        @param seed, device, dtype: as for ParserModel
+        """
+        super(StudentParserModel, self).__init__(embeddings, n_features=len(feature_idx),
+                                                 hidden_size=hidden_size, n_classes=n_classes,
+                                                 seed=seed, device=device, dtype=dtype)
+        self.register_buffer('feature_idx', torch.tensor(feature_idx, dtype=torch.long, device=device))
+
+    def forward(self, w):
+        """ Run the model forward on the selected feature columns of `w`.
+
+        @param w (Tensor): input tensor of tokens with all parser features (batch_size, total_features)
+
+        @return logits (Tensor): tensor of predictions (batch_size, n_classes)
+        """
+        return super(StudentParserModel, self).forward(w.index_select(1, self.feature_idx.to(w.device)))
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Simple sanity check for parser_model.py')
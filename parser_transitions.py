@@ -10,15 +10,19 @@ Sahil Chopra <schopra8@stanford.edu>
 Haoshen Hong <haoshen@stanford.edu>
 """
 import sys
+import time
 
 class PartialParse(object):
-    def __init__(self, sentence):
+    def __init__(self, sentence, ex=None):
         """Initializes this partial parse.
 
         @param sentence (list of str): The sentence to be parsed as a list of words.
+        @param ex (dict): Optional vectorized example (word/pos/label id lists) for the sentence,
+                          carried along so the model can featurize this parse without looking it up.
         """
         # The sentence being parsed is kept for bookkeeping purposes.
         self.sentence = sentence
+        self.ex = ex
 
         # Initializes:
         #   self.stack: The current stack represented as a list with the top of the
@@ -33,6 +37,9 @@ class PartialParse(object):
         self.stack = ['ROOT']
         self.buffer = sentence[:]
         self.dependencies = []
+        self.n_steps = 0
+        self.seconds = 0.
+        self.fallback = False
 
     def parse_step(self, transition):
         """Performs a single parse step by applying the given transition to this partial parse
@@ -61,6 +68,17 @@ class PartialParse(object):
             self.dependencies.append((second_item_on_stack, first_item_on_stack_removed))
 
         ### END YOUR CODE
+        self.n_steps += 1
+
+    def finish_right_branching(self):
+        """Completes this parse without a model: shifts the rest of the buffer and then right-arcs
+        the stack down to ROOT, so every remaining word is attached to the word before it.
+        Used as the fallback for parses that exceed their decoding budget.
+        """
+        while len(self.buffer) > 0:
+            self.parse_step("S")
+        while len(self.stack) > 1:
+            self.parse_step("RA")
 
     def parse(self, transitions):
         """Applies the provided transitions to this PartialParse
@@ -76,7 +94,8 @@ class PartialParse(object):
         return self.dependencies
 
 
-def minibatch_parse(sentences, model, batch_size):
+def minibatch_parse(sentences, model, batch_size, examples=None, n_groups=1,
+                    max_steps=None, time_budget=None, stats=None):
     """Parses a list of sentences in minibatches using a model.
 
     @param sentences (list of list of str): A list of sentences to be parsed
@@ -87,7 +106,20 @@ def minibatch_parse(sentences, model, batch_size):
                                     transitions = model.predict(partial_parses)
                                 transitions[i] will be the next transition to apply to partial_parses[i].
     @param batch_size (int): The number of PartialParses to include in each minibatch
-
+    @param examples (list of dict): Optional vectorized examples aligned with sentences; examples[i]
+                                    is attached to the PartialParse for sentences[i] as its `ex`.
+    @param n_groups (int): Number of groups the parses are split into, each decoded on its own thread.
+                           While one group is inside the model's forward pass (where torch releases the
+                           GIL), the others extract features and apply transitions, so the two overlap.
+                           Every parse still sees the same sequence of predictions.
+    @param max_steps (int): Optional per-sentence budget of transitions (every transition the parse
+                            has applied counts, including ones forced by the parser state)
+    @param time_budget (float): Optional per-sentence budget in seconds of decoding time. Each parse is
+                                charged the wall time of every minibatch step it takes part in (the
+                                forward pass and the transitions of that minibatch), not time spent
+                                waiting for a place in a minibatch
+    @param stats (dict): If given, stats['fallback'] is set to the indices of the sentences that ran
+                         over budget and were completed with PartialParse.finish_right_branching
 
     @return dependencies (list of dependency lists): A list where each element is the dependencies
                                                      list for a parsed sentence. Ordering should be the
@@ -110,18 +142,22 @@ def minibatch_parse(sentences, model, batch_size):
     ###             to remove objects from the `unfinished_parses` list. This will free the underlying memory that
     ###             is being accessed by `partial_parses` and may cause your code to crash.
 
-    partial_parses = [PartialParse(sentence) for sentence in sentences]
-    unfinished_parses = partial_parses[:]
-    
-    while len(unfinished_parses) != 0:
-        minibatch = unfinished_parses[:batch_size]
-        transitions = model.predict(minibatch)
-        for i in range(len(minibatch)):
-            minibatch[i].parse_step(transitions[i])        
-            # if len(minibatch[i].buffer) == 0 and len(minibatch[i].stack) == 1:
-                # unfinished_parses.pop(i)
-            unfinished_parses = [parse for parse in unfinished_parses if not (len(parse.stack) == 1 and len(parse.buffer) == 0)]
-    
+    if examples is None:
+        examples = [None] * len(sentences)
+    partial_parses = [PartialParse(sentence, ex) for sentence, ex in zip(sentences, examples)]
+    if n_groups <= 1 or len(partial_parses) < 2:
+        _parse_group(partial_parses, model, batch_size, max_steps, time_budget)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        group_batch_size = max(1, -(-batch_size // n_groups))
+        groups = [partial_parses[g::n_groups] for g in range(n_groups)]
+        with ThreadPoolExecutor(max_workers=n_groups) as executor:
+            for future in [executor.submit(_parse_group, group, model, group_batch_size, max_steps, time_budget)
+                           for group in groups]:
+                future.result()
+    if stats is not None:
+        stats['fallback'] = [i for i, p in enumerate(partial_parses) if p.fallback]
+
     dependencies = [partial_parse.dependencies for partial_parse in partial_parses]
 
     ### END YOUR CODE
@@ -129,6 +165,33 @@ def minibatch_parse(sentences, model, batch_size):
     return dependencies
 
 
+def _parse_group(partial_parses, model, batch_size, max_steps=None, time_budget=None):
+    """Runs the minibatch parse loop until every parse in `partial_parses` is finished.
+
+    Parses that have taken `max_steps` transitions or been charged `time_budget` seconds of
+    minibatch steps are completed right-branching and flagged as `fallback`.
+    """
+    unfinished_parses = partial_parses[:]
+
+    while len(unfinished_parses) != 0:
+        minibatch = unfinished_parses[:batch_size]
+        start = time.perf_counter()
+        transitions = model.predict(minibatch)
+        for i in range(len(minibatch)):
+            minibatch[i].parse_step(transitions[i])
+        elapsed = time.perf_counter() - start
+        for parse in minibatch:
+            parse.seconds += elapsed
+        over_budget = [parse for parse in minibatch
+                       if (max_steps is not None and parse.n_steps >= max_steps)
+                       or (time_budget is not None and parse.seconds >= time_budget)]
+        for parse in over_budget:
+            if not (len(parse.stack) == 1 and len(parse.buffer) == 0):
+                parse.finish_right_branching()
+                parse.fallback = True
+        unfinished_parses = [parse for parse in unfinished_parses if not (len(parse.stack) == 1 and len(parse.buffer) == 0)]
+
+
 def test_step(name, transition, stack, buf, deps,
               ex_stack, ex_buf, ex_deps):
     """Tests that a single parse step returns the expected output"""
@@ -289,6 +352,25 @@ def test_minibatch_parse():
     else:
         print("minibatch_parse returned empty deps {:}".format(deps))
         passed = False
+
+    # Budget test: parses over budget are completed right-branching
+    sentences = [["left", "arcs", "only", "again"], ["right"]]
+    stats = {}
+    deps = minibatch_parse(sentences, DummyModel(), 2, max_steps=2, stats=stats)
+    if test_dependencies("minibatch_parse", deps[0],
+                         (('ROOT', 'left'), ('arcs', 'only'), ('left', 'arcs'), ('only', 'again'))) and \
+    test_dependencies("minibatch_parse", deps[1], (('ROOT', 'right'),)) and \
+    test_dependencies("minibatch_parse fallback", stats['fallback'], (0,)):
+        print("max_steps budget test passed!")
+    else:
+        passed = False
+    stats = {}
+    deps = minibatch_parse([["left", "arcs"]], DummyModel(), 1, time_budget=0., stats=stats)
+    if test_dependencies("minibatch_parse", deps[0], (('ROOT', 'left'), ('left', 'arcs'))) and \
+    test_dependencies("minibatch_parse fallback", stats['fallback'], (0,)):
+        print("time budget test passed!")
+    else:
+        passed = False
     return passed
 
 
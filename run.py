@@ -8,28 +8,41 @@ CS224N 2019-20: Homework 3
 run.py: Run the dependency parser.
 Sahil Chopra <schopra8@stanford.edu>
 Haoshen Hong <haoshen@stanford.edu>
+
+Usage:
+    python run.py train [-d] [--resume CHECKPOINT] ...     (the default when no command is given)
+    python run.py batch-sweep [-d] [--settings 50,500,2000,500x4] [--n-epochs 3] ...
+    python run.py eval MODEL_DIR [CONLL]
+    python run.py parse MODEL_DIR INPUT OUTPUT [--tagged] ...
+    python run.py bench MODEL_DIR CONLL [--batch-sizes 1000,5000] ...
+    python run.py export-numpy MODEL_DIR OUTPUT_DIR [--check CONLL]
+    python run.py compact MODEL_DIR OUTPUT_DIR [--min-count N] [--max-vocab N]
+    python run.py stats CONLL [CONLL ...]
+    python run.py index CONLL [CONLL ...] [--shards K]
+    python run.py vocab MODEL_DIR [--top N]
+
+torch and numpy are only imported by the commands and functions that need them, so `stats`
+and `vocab` start without loading them, and importing this module has no side effects.
+MODEL_DIR may also be a directory written by `export-numpy`, which `eval`, `parse` and
+`bench` run with the NumPy runtime of numpy_model.py.
 """
 from datetime import datetime
 import os
+import sys
 import pickle
 import math
 import time
 import argparse
-
-from torch import nn, optim
-import torch
-
-from parser_model import ParserModel
-from utils.parser_utils import minibatches, load_and_preprocess_data, AverageMeter
-
-parser = argparse.ArgumentParser(description='Train neural dependency parser in python')
-parser.add_argument('-d', '--debug', action='store_true', help='whether to enter debug mode')
-args = parser.parse_args()
+import copy
+import functools
 
 # -----------------
 # Primary Functions
 # -----------------
-def train(parser, train_data, dev_data, output_path, batch_size=1024, n_epochs=10, lr=0.0005):
+def train(parser, train_data, dev_data, output_path, batch_size=1024, n_epochs=10, lr=0.0005,
+          checkpoint_path=None, checkpoint_every=1000, resume_from=None,
+          eval_every=0, eval_subsample=500, parallel_eval=False, metrics=None,
+          accumulation_steps=1, lr_schedule='constant', warmup_steps=0, history=None):
     """ Train the neural dependency parser.
 
     @param parser (Parser): Neural Dependency Parser
@@ -39,7 +52,27 @@ def train(parser, train_data, dev_data, output_path, batch_size=1024, n_epochs=1
     @param batch_size (int): Number of examples in a single batch
     @param n_epochs (int): Number of training epochs
     @param lr (float): Learning rate
+    @param checkpoint_path (str): Path of the resumable checkpoint (None disables checkpointing)
+    @param checkpoint_every (int): Steps between periodic checkpoints; one is also written after every epoch
+    @param resume_from (str): Checkpoint to restore model, optimizer, progress and RNG state from
+    @param eval_every (int): If > 0, evaluate on a fixed dev subsample every `eval_every` steps and on the
+                             full dev set only when the subsample UAS improves and at the end of training.
+                             If 0, evaluate on the full dev set after every epoch.
+    @param eval_subsample (int): Size of the stratified dev subsample used when `eval_every` > 0
+    @param parallel_eval (bool): Run full dev evaluations in a separate process while training continues
+    @param metrics (TrainingMetrics): training telemetry (see utils/metrics_utils.py), None disables it
+    @param accumulation_steps (int): Minibatches whose gradients are accumulated into one optimizer step,
+                                     for an effective batch of batch_size * accumulation_steps
+    @param lr_schedule (str): 'constant', 'linear' or 'cosine' decay of the learning rate over all
+                              optimizer steps (see lr_multiplier)
+    @param warmup_steps (int): Optimizer steps over which the learning rate ramps up linearly to `lr`
+    @param history (list): If given, a dict with the training throughput and dev UAS of every epoch is
+                           appended to it
     """
+    import torch
+    from utils.checkpoint_utils import AsyncCheckpointer, snapshot_training_state, load_checkpoint, \
+        get_rng_state, set_rng_state
+
     best_dev_UAS = 0
 
 
@@ -63,18 +96,102 @@ def train(parser, train_data, dev_data, output_path, batch_size=1024, n_epochs=1
 
     ### END YOUR CODE
 
-    for epoch in range(n_epochs):
-        print("Epoch {:} out of {:}".format(epoch + 1, n_epochs))
-        dev_UAS = train_for_epoch(parser, train_data, dev_data, optimizer, loss_func, batch_size)
+    scheduler = None
+    if lr_schedule != 'constant' or warmup_steps > 0:
+        n_steps = n_epochs * math.ceil(math.ceil(len(train_data) / batch_size) / accumulation_steps)
+        scheduler = torch.optim.lr_scheduler.LambdaLR(
+            optimizer, lambda step: lr_multiplier(step, n_steps, lr_schedule, warmup_steps))
+
+    start_epoch = start_step = 0
+    resumed_subsample_UAS = 0
+    if resume_from is not None:
+        state = load_checkpoint(resume_from)
+        parser.model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        if scheduler is not None and state.get('scheduler') is not None:
+            scheduler.load_state_dict(state['scheduler'])
+        start_epoch, start_step = state['epoch'], state['step']
+        best_dev_UAS = state['best_dev_UAS']
+        resumed_subsample_UAS = state.get('best_subsample_UAS', 0)
+        set_rng_state(state['rng_state'])
+        print("Resuming from {} at epoch {}, step {}".format(resume_from, start_epoch + 1, start_step))
+
+    checkpointer = AsyncCheckpointer()
+    evaluator = None
+    if eval_every > 0:
+        evaluator = DevEvaluator(parser, dev_data, eval_subsample, parallel_eval)
+        evaluator.best_subsample_UAS = resumed_subsample_UAS
+
+    def best_subsample_UAS():
+        return evaluator.best_subsample_UAS if evaluator is not None else 0
+
+    def record_dev_UAS(dev_UAS, weights):
+        nonlocal best_dev_UAS
         if dev_UAS > best_dev_UAS:
             best_dev_UAS = dev_UAS
             print("New best dev UAS! Saving model.")
-            torch.save(parser.model.state_dict(), output_path)
-        print("")
+            checkpointer.save(weights, output_path)
+
+    try:
+        for epoch in range(start_epoch, n_epochs):
+            print("Epoch {:} out of {:}".format(epoch + 1, n_epochs))
+            # Shuffling for this epoch is drawn from this state, so a mid-epoch resume can replay it.
+            epoch_rng_state = get_rng_state()
+            if metrics is not None:
+                metrics.epoch = epoch
+            last_step = start_step if epoch == start_epoch else 0
+
+            def on_step(step):
+                # With gradient accumulation, steps advance by several minibatches per call, so
+                # the periodic actions run whenever a multiple of their period has been passed.
+                nonlocal last_step
+                evaluate_now, checkpoint_now = (every > 0 and step // every > last_step // every
+                                                for every in (eval_every, checkpoint_every))
+                last_step = step
+                if evaluator is not None:
+                    if evaluate_now:
+                        evaluator.evaluate_subsample()
+                    for dev_UAS, weights in evaluator.poll():
+                        record_dev_UAS(dev_UAS, weights)
+                if checkpoint_path is not None and checkpoint_now:
+                    checkpointer.save(snapshot_training_state(parser.model, optimizer, epoch, step,
+                                                              epoch_rng_state, best_dev_UAS, scheduler,
+                                                              best_subsample_UAS()),
+                                      checkpoint_path)
+
+            epoch_stats = {}
+            dev_UAS = train_for_epoch(parser, train_data, dev_data, optimizer, loss_func, batch_size,
+                                      start_step=start_step if epoch == start_epoch else 0,
+                                      step_callback=on_step, evaluate=evaluator is None, metrics=metrics,
+                                      accumulation_steps=accumulation_steps, scheduler=scheduler,
+                                      epoch_stats=epoch_stats)
+            if dev_UAS is not None:
+                record_dev_UAS(dev_UAS, snapshot_weights(parser.model))
+            if checkpoint_path is not None:
+                checkpointer.save(snapshot_training_state(parser.model, optimizer, epoch + 1, 0,
+                                                          get_rng_state(), best_dev_UAS, scheduler,
+                                                          best_subsample_UAS()),
+                                  checkpoint_path)
+            if history is not None:
+                history.append(dict(epoch_stats, epoch=epoch + 1, dev_UAS=dev_UAS,
+                                    lr=optimizer.param_groups[0]['lr']))
+            print("")
+
+        if evaluator is not None:
+            print("Final evaluation on full dev set")
+            evaluator.submit_full()
+            for dev_UAS, weights in evaluator.poll(wait=True):
+                record_dev_UAS(dev_UAS, weights)
+    finally:
+        if evaluator is not None:
+            evaluator.close()
+        checkpointer.close()
     return best_dev_UAS
 
 
-def train_for_epoch(parser, train_data, dev_data, optimizer, loss_func, batch_size):
+def train_for_epoch(parser, train_data, dev_data, optimizer, loss_func, batch_size,
+                    start_step=0, step_callback=None, evaluate=True, metrics=None,
+                    accumulation_steps=1, scheduler=None, epoch_stats=None):
     """ Train the neural dependency parser for single epoch.
 
     Note: In PyTorch we can signify train versus test by specifying
@@ -86,18 +203,46 @@ def train_for_epoch(parser, train_data, dev_data, optimizer, loss_func, batch_si
     @param optimizer (nn.Optimizer): Adam Optimizer
     @param loss_func (nn.CrossEntropyLoss): Cross Entropy Loss Function
     @param batch_size (int): batch size
+    @param start_step (int): number of leading minibatches to skip (already trained before a resume)
+    @param step_callback (callable): called with the number of minibatches done after each optimizer step
+    @param evaluate (bool): whether to parse dev_data at the end of the epoch
+    @param metrics (TrainingMetrics): records throughput, per-phase step timing and memory use (None disables)
+    @param accumulation_steps (int): number of minibatches whose gradients make up one optimizer step
+    @param scheduler (LRScheduler): learning rate schedule, stepped after every optimizer step
+    @param epoch_stats (dict): if given, receives the number of examples trained on, the training time
+                               in seconds (without dev evaluation or the time spent in
+                               step_callback) and the examples per second
 
-    @return dev_UAS (float): Unlabeled Attachment Score (UAS) for dev data
+    @return dev_UAS (float): Unlabeled Attachment Score (UAS) for dev data, None if not evaluated
     """
+    import torch
+    from utils.parser_utils import minibatches, AverageMeter, PinnedBuffers, to_device
+
     parser.model.train() # Places model in "train" mode
     n_minibatches = math.ceil(len(train_data) / batch_size)
     loss_meter = AverageMeter()
+    lap = metrics.lap if metrics is not None else (lambda phase: None)
 
+    buffers = PinnedBuffers()
+    start = time.time()
+    callback_seconds = 0.
+    n_examples = 0
+    if metrics is not None:
+        metrics.start()
     for i, (train_x, train_y) in enumerate(minibatches(train_data, batch_size)):
-        optimizer.zero_grad()   # remove any baggage in the optimizer
+        if i < start_step:
+            continue
+        # Gradients of the minibatches of one accumulation window are summed, each scaled by
+        # the window length, so the update is that of their mean loss.
+        window_start = i - i % accumulation_steps
+        window = min(accumulation_steps, n_minibatches - window_start)
+        update = i + 1 == window_start + window
+        if i == window_start or i == start_step:
+            optimizer.zero_grad()   # remove any baggage in the optimizer
         loss = 0. # store loss for this batch here
-        train_x = torch.tensor(train_x)
-        train_y = torch.tensor(train_y.nonzero()[1])
+        train_x = to_device(torch.from_numpy(train_x).long(), parser.model.device, buffers)
+        train_y = to_device(torch.from_numpy(train_y.nonzero()[1]), parser.model.device, buffers)
+        lap('batch')
 
         ### YOUR CODE HERE (~4 Lines)
         ### TODO:
@@ -112,14 +257,39 @@ def train_for_epoch(parser, train_data, dev_data, optimizer, loss_func, batch_si
         ###     Optimizer Step: https://pytorch.org/docs/stable/optim.html#optimizer-step
         logits = parser.model(train_x)
         loss = loss_func(logits, train_y)
-        loss.backward()
-        optimizer.step()
+        lap('forward')
+        (loss / window).backward()
+        lap('backward')
+        if update:
+            optimizer.step()
+            if scheduler is not None:
+                scheduler.step()
+        lap('optimizer')
 
 
         ### END YOUR CODE
         loss_meter.update(loss.item())
+        n_examples += len(train_y)
+        if update and step_callback is not None:
+            callback_start = time.time()
+            step_callback(i + 1)
+            callback_seconds += time.time() - callback_start
+        if metrics is not None:
+            lap('callback')
+            metrics.end_step(i + 1, len(train_y), loss_meter.val, update=update)
 
+    if metrics is not None:
+        metrics.flush(n_minibatches)
+    # Evaluations and checkpoints run by step_callback are not training time.
+    train_seconds = time.time() - start - callback_seconds
+    if epoch_stats is not None:
+        epoch_stats.update(examples=n_examples, train_seconds=train_seconds,
+                           examples_per_sec=n_examples / max(train_seconds, 1e-9))
     print ("Average Train Loss: {}".format(loss_meter.avg))
+    print("Trained on {} examples in {:.2f} seconds ({:.0f} examples/sec)".format(
+        n_examples, train_seconds, n_examples / max(train_seconds, 1e-9)))
+    if not evaluate:
+        return None
 
     print("Evaluating on dev set",)
     parser.model.eval() # Places model in "eval" mode
@@ -128,40 +298,488 @@ def train_for_epoch(parser, train_data, dev_data, optimizer, loss_func, batch_si
     return dev_UAS
 
 
-if __name__ == "__main__":
+# ----------------
+# Helper Functions
+# ----------------
+REFERENCE_BATCH_SIZE = 50
+
+
+def scaled_lr(lr, effective_batch_size, scaling='none'):
+    """ Scales a learning rate tuned for REFERENCE_BATCH_SIZE to a larger effective batch:
+    'linear' multiplies it by the batch size ratio, 'sqrt' by its square root ('none' keeps it). """
+    ratio = effective_batch_size / REFERENCE_BATCH_SIZE
+    return lr * {'none': 1.0, 'linear': ratio, 'sqrt': math.sqrt(ratio)}[scaling]
+
+
+def lr_multiplier(step, n_steps, schedule='constant', warmup_steps=0):
+    """ Factor applied to the base learning rate at optimizer step `step` of `n_steps`: a linear
+    warmup over `warmup_steps`, then constant, linear decay to 0 or cosine decay to 0. """
+    if step < warmup_steps:
+        return (step + 1) / warmup_steps
+    progress = min(1.0, (step - warmup_steps) / max(1, n_steps - warmup_steps))
+    if schedule == 'linear':
+        return 1.0 - progress
+    if schedule == 'cosine':
+        return 0.5 * (1.0 + math.cos(math.pi * progress))
+    return 1.0
+
+
+def snapshot_weights(model):
+    return {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
+
+
+def _full_dev_UAS(parser, dev_data):
+    parser.model.eval()
+    dev_UAS, _ = parser.parse(dev_data)
+    return dev_UAS
+
+
+class DevEvaluator(object):
+    """ Step-based dev evaluation for train().
+
+    Every call to `evaluate_subsample` parses a fixed stratified subsample of the dev set.
+    When the subsample UAS improves, the current weights become a candidate for a full dev
+    evaluation, which runs inline or, with `parallel`, in a worker process on a snapshot of
+    the weights while training continues. While a full evaluation is running, only the
+    newest candidate is kept waiting.
+    """
+    def __init__(self, parser, dev_data, subsample_size=500, parallel=False):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        from utils.parser_utils import stratified_sample
+
+        self.parser = parser
+        self.dev_data = dev_data
+        self.dev_subsample = stratified_sample(dev_data, subsample_size)
+        self.best_subsample_UAS = 0
+        self.executor = None
+        if parallel:
+            self.executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+        self.running = None   # (future, weights) of the full evaluation in flight
+        self.waiting = None   # weights of the next candidate
+        self.results = []
+
+    def evaluate_subsample(self):
+        self.parser.model.eval()
+        subsample_UAS, _ = self.parser.parse(self.dev_subsample)
+        self.parser.model.train()
+        print("- dev subsample UAS: {:.2f}".format(subsample_UAS * 100.0))
+        if subsample_UAS > self.best_subsample_UAS:
+            self.best_subsample_UAS = subsample_UAS
+            self.submit_full()
+
+    def submit_full(self):
+        weights = snapshot_weights(self.parser.model)
+        if self.executor is None:
+            print("Evaluating on full dev set")
+            dev_UAS = _full_dev_UAS(self.parser, self.dev_data)
+            self.parser.model.train()
+            print("- dev UAS: {:.2f}".format(dev_UAS * 100.0))
+            self.results.append((dev_UAS, weights))
+        else:
+            self.waiting = weights
+            self._launch()
+
+    def _launch(self):
+        if self.running is not None or self.waiting is None:
+            return
+        snapshot = copy.copy(self.parser)
+        snapshot.model = copy.deepcopy(self.parser.model).cpu()
+        snapshot.model.load_state_dict(self.waiting)
+        self.running = (self.executor.submit(_full_dev_UAS, snapshot, self.dev_data), self.waiting)
+        self.waiting = None
+
+    def poll(self, wait=False):
+        """ Returns the (dev_UAS, weights) pairs of full evaluations finished since the last call.
+
+        @param wait (bool): block until every submitted evaluation has finished
+        """
+        while self.running is not None and (wait or self.running[0].done()):
+            future, weights = self.running
+            self.running = None
+            dev_UAS = future.result()
+            print("- dev UAS: {:.2f}".format(dev_UAS * 100.0))
+            self.results.append((dev_UAS, weights))
+            self._launch()
+        results, self.results = self.results, []
+        return results
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+# --------
+# Commands
+# --------
+def cmd_train(args):
+    import torch
+    from parser_model import ParserModel
+    from utils.parser_utils import load_and_preprocess_data, save_parser, set_seed, check_deterministic_decoding, \
+        torch_dtype
+    from utils.metrics_utils import TrainingMetrics
+
     debug = args.debug
+    device = args.device or ('cuda' if torch.cuda.is_available() else 'cpu')
 
     assert (torch.__version__.split(".") >= ["1", "0", "0"]), "Please install torch version >= 1.0.0"
 
+    if args.seed is not None:
+        set_seed(args.seed, num_threads=args.threads, device=device)
+    elif args.threads is not None:
+        torch.set_num_threads(args.threads)
+
     print(80 * "=")
     print("INITIALIZING")
     print(80 * "=")
-    parser, embeddings, train_data, dev_data, test_data = load_and_preprocess_data(debug)
+    parser, embeddings, train_data, dev_data, test_data = load_and_preprocess_data(debug, seed=args.seed)
 
     start = time.time()
-    model = ParserModel(embeddings)
+    model = ParserModel(embeddings, seed=args.seed, device=device, dtype=torch_dtype(args.dtype))
     parser.model = model
     print("took {:.2f} seconds\n".format(time.time() - start))
 
     print(80 * "=")
     print("TRAINING")
     print(80 * "=")
-    output_dir = "results/{:%Y%m%d_%H%M%S}/".format(datetime.now())
+    if args.resume is not None:
+        output_dir = os.path.dirname(os.path.abspath(args.resume)) + "/"
+    else:
+        output_dir = "results/{:%Y%m%d_%H%M%S}/".format(datetime.now())
     output_path = output_dir + "model.weights"
+    checkpoint_path = output_dir + "checkpoint.pt"
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
+    # Vocabularies needed to reload the weights for parsing (see parse_conll.py).
+    save_parser(parser, output_dir + "parser.pkl")
+    metrics = None
+    if args.metrics_every > 0:
+        metrics = TrainingMetrics(args.metrics_every, args.metrics_file or output_dir + "metrics.jsonl", device)
+
+    lr = scaled_lr(args.lr, args.batch_size * args.accumulation_steps, args.lr_scaling)
+    train(parser, train_data, dev_data, output_path, batch_size=args.batch_size, n_epochs=args.n_epochs, lr=lr,
+          checkpoint_path=checkpoint_path, checkpoint_every=args.checkpoint_every, resume_from=args.resume,
+          eval_every=args.eval_every, eval_subsample=args.eval_subsample, parallel_eval=args.parallel_eval,
+          metrics=metrics, accumulation_steps=args.accumulation_steps, lr_schedule=args.lr_schedule,
+          warmup_steps=args.warmup_steps)
 
-    train(parser, train_data, dev_data, output_path, batch_size=50, n_epochs=10, lr=0.0005)
+    if args.check_determinism:
+        print(80 * "=")
+        print("DETERMINISM CHECK")
+        print(80 * "=")
+        parser.model.eval()
+        check_deterministic_decoding(parser, dev_data)
 
     if not debug:
         print(80 * "=")
         print("TESTING")
         print(80 * "=")
         print("Restoring the best model weights found on the dev set")
-        parser.model.load_state_dict(torch.load(output_path))
+        parser.model.load_state_dict(torch.load(output_path, map_location=device))
         print("Final evaluation on test set",)
         parser.model.eval()
         UAS, dependencies = parser.parse(test_data)
         print("- test UAS: {:.2f}".format(UAS * 100.0))
         print("Done!")
+
+
+def cmd_batch_sweep(args):
+    import torch
+    from parser_model import ParserModel
+    from utils.parser_utils import load_and_preprocess_data, set_seed, torch_dtype
+
+    device = args.device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    set_seed(args.seed, num_threads=args.threads, device=device)
+    parser, embeddings, train_data, dev_data, test_data = load_and_preprocess_data(args.debug, seed=args.seed)
+    output_dir = "results/sweep_{:%Y%m%d_%H%M%S}/".format(datetime.now())
+    os.makedirs(output_dir)
+
+    rows = []
+    for batch_size, accumulation_steps in args.settings:
+        effective = batch_size * accumulation_steps
+        lr = scaled_lr(args.lr, effective, args.lr_scaling)
+        print(80 * "=")
+        print("BATCH {} x {} (effective {}), lr {:.6f}".format(batch_size, accumulation_steps, effective, lr))
+        print(80 * "=")
+        # Every setting starts from the same weights and shuffling.
+        set_seed(args.seed, num_threads=args.threads, device=device)
+        parser.model = ParserModel(embeddings, seed=args.seed, device=device, dtype=torch_dtype(args.dtype))
+        history = []
+        best_dev_UAS = train(parser, train_data, dev_data,
+                             output_dir + "{}x{}.weights".format(batch_size, accumulation_steps),
+                             batch_size=batch_size, n_epochs=args.n_epochs, lr=lr,
+                             accumulation_steps=accumulation_steps, lr_schedule=args.lr_schedule,
+                             warmup_steps=args.warmup_steps, history=history)
+        train_seconds = sum(h['train_seconds'] for h in history)
+        rows.append((batch_size, accumulation_steps, effective, lr,
+                     sum(h['examples'] for h in history) / train_seconds, train_seconds, best_dev_UAS))
+
+    print(80 * "=")
+    print("THROUGHPUT / ACCURACY ({} epochs, schedule {}, warmup {}, lr scaling {})".format(
+        args.n_epochs, args.lr_schedule, args.warmup_steps, args.lr_scaling))
+    print(80 * "=")
+    print("{:>6} {:>6} {:>10} {:>10} {:>12} {:>10} {:>8}".format(
+        "batch", "accum", "effective", "lr", "examples/s", "train s", "dev UAS"))
+    for batch_size, accumulation_steps, effective, lr, speed, seconds, UAS in rows:
+        print("{:>6} {:>6} {:>10} {:>10.6f} {:>12.0f} {:>10.2f} {:>8.2f}".format(
+            batch_size, accumulation_steps, effective, lr, speed, seconds, UAS * 100.0))
+
+
+def _load_model_dir(model_dir, device='cpu'):
+    from utils.parser_utils import load_model_dir
+    return load_model_dir(model_dir, device)
+
+
+def _read_vectorized(parser, conll_file):
+    from utils.parser_utils import Config, read_conll
+    return parser.vectorize(read_conll(conll_file, lowercase=Config().lowercase))
+
+
+def cmd_eval(args):
+    from utils.parser_utils import Config
+
+    parser = _load_model_dir(args.model_dir, args.device)
+    conll_file = args.conll or os.path.join(Config().data_path, Config().test_file)
+    dataset = _read_vectorized(parser, conll_file)
+    start = time.time()
+    UAS, _ = parser.parse(dataset, eval_batch_size=args.batch_size)
+    print("- UAS on {}: {:.2f} ({} sentences, {:.2f} seconds)".format(
+        conll_file, UAS * 100.0, len(dataset), time.time() - start))
+
+
+def cmd_parse(args):
+    import parse_conll
+    parse_conll.main(args)
+
+
+def cmd_export_numpy(args):
+    from utils.parser_utils import export_numpy_model, load_numpy_parser, check_numpy_model
+
+    parser = _load_model_dir(args.model_dir)
+    export_numpy_model(parser, args.output_dir)
+    print("Exported NumPy inference model to {}".format(args.output_dir))
+    if args.check is not None:
+        dataset = _read_vectorized(parser, args.check)
+        if not check_numpy_model(parser, load_numpy_parser(args.output_dir), dataset):
+            sys.exit(1)
+
+
+def cmd_compact(args):
+    from utils.parser_utils import export_compact_model
+
+    if not os.path.exists(os.path.join(args.model_dir, 'model.weights')):
+        sys.exit("compact needs a directory with parser.pkl and model.weights written by train: {}".format(
+            args.model_dir))
+    parser = _load_model_dir(args.model_dir)
+    n_tokens = parser.n_tokens
+    index = export_compact_model(parser, args.output_dir, n_max=args.max_vocab, min_count=args.min_count)
+    print("Compacted vocabulary from {} to {} tokens; wrote parser.pkl and model.weights to {}".format(
+        n_tokens, len(index), args.output_dir))
+
+
+def cmd_bench(args):
+    import torch
+    from utils.parser_utils import check_deterministic_decoding
+
+    parser = _load_model_dir(args.model_dir, args.device)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    dataset = _read_vectorized(parser, args.conll)
+    if args.max_sentences is not None:
+        dataset = dataset[:args.max_sentences]
+    n_tokens = sum(len(ex['word']) - 1 for ex in dataset)
+    print("{} sentences, {} tokens, torch threads: {}".format(len(dataset), n_tokens, torch.get_num_threads()))
+    print("{:>10} {:>8} {:>12} {:>12}".format("batch", "groups", "sents/sec", "tokens/sec"))
+    for batch_size in args.batch_sizes:
+        for groups in args.pipeline_groups:
+            parser.pipeline_groups = groups
+            best = float('inf')
+            for _ in range(args.repeat):
+                start = time.time()
+                parser.predict_dependencies(dataset, batch_size)
+                best = min(best, time.time() - start)
+            print("{:>10d} {:>8d} {:>12.1f} {:>12.1f}".format(batch_size, groups, len(dataset) / best,
+                                                              n_tokens / best))
+    if args.check_determinism:
+        check_deterministic_decoding(parser, dataset, batch_sizes=args.batch_sizes,
+                                     pipeline_groups=args.pipeline_groups)
+
+
+def cmd_stats(args):
+    from utils.parser_utils import read_conll
+
+    for conll_file in args.conll:
+        examples = read_conll(conll_file)
+        lengths = sorted(len(ex['word']) for ex in examples)
+        if len(lengths) == 0:
+            print("{}: no sentences".format(conll_file))
+            continue
+        pct = lambda p: lengths[min(len(lengths) - 1, int(p * len(lengths)))]
+        print("{}: {} sentences, {} tokens, {} word types, {} POS tags".format(
+            conll_file, len(examples), sum(lengths),
+            len(set(w for ex in examples for w in ex['word'])), len(set(p for ex in examples for p in ex['pos']))))
+        print("  sentence length: mean {:.1f}, median {}, p90 {}, p99 {}, max {}".format(
+            sum(lengths) / float(len(lengths)), pct(0.5), pct(0.9), pct(0.99), lengths[-1]))
+
+
+def cmd_index(args):
+    from utils.conll_index import ConllIndex
+
+    for conll_file in args.conll:
+        start = time.time()
+        index = ConllIndex(conll_file)
+        print("{}: {} sentences, index {} ({:.2f} seconds)".format(
+            conll_file, len(index), index.index_path, time.time() - start))
+        if args.shards > 1:
+            for i, (first, end) in enumerate(index.shards(args.shards)):
+                print("  shard {}: sentences {}-{}, {} bytes".format(
+                    i, first, end - 1, index.offsets[end] - index.offsets[first]))
+
+
+def cmd_vocab(args):
+    from utils.parser_utils import L_PREFIX, P_PREFIX
+
+    with open(os.path.join(args.model_dir, 'parser.pkl'), 'rb') as f:
+        parser = pickle.load(f)
+    n_labels = sum(1 for t in parser.tok2id if t.startswith(L_PREFIX))
+    n_pos = sum(1 for t in parser.tok2id if t.startswith(P_PREFIX))
+    print("{} tokens: {} words, {} POS tags, {} labels (incl. special tokens)".format(
+        parser.n_tokens, parser.n_tokens - n_labels - n_pos, n_pos, n_labels))
+    counts = getattr(parser, 'word_counts', None)
+    if counts:
+        print("Most frequent training words:")
+        for w, c in counts.most_common(args.top):
+            print("  {:<20} {:>8d} {}".format(w, c, "" if w in parser.tok2id else "(pruned)"))
+
+
+def _add_optimization_arguments(p, n_epochs=10, lr_scaling='none', lr_schedule='constant'):
+    p.add_argument('--n-epochs', type=int, default=n_epochs, help='number of training epochs')
+    p.add_argument('--lr', type=float, default=0.0005,
+                   help='learning rate for a batch of {} (see --lr-scaling)'.format(REFERENCE_BATCH_SIZE))
+    p.add_argument('--lr-scaling', choices=['none', 'linear', 'sqrt'], default=lr_scaling,
+                   help='scale --lr with the effective batch size relative to {}'.format(REFERENCE_BATCH_SIZE))
+    p.add_argument('--lr-schedule', choices=['constant', 'linear', 'cosine'], default=lr_schedule,
+                   help='decay of the learning rate over training')
+    p.add_argument('--warmup-steps', type=int, default=0,
+                   help='optimizer steps of linear learning rate warmup')
+
+
+def build_arg_parser():
+    from utils.parser_utils import DTYPES
+
+    argparser = argparse.ArgumentParser(description='Train and run the neural dependency parser')
+    subparsers = argparser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('train', help='train a parser (default command)')
+    p.add_argument('-d', '--debug', action='store_true', help='whether to enter debug mode')
+    p.add_argument('--resume', metavar='CHECKPOINT', default=None,
+                   help='resume training from a checkpoint written by a previous run')
+    p.add_argument('--checkpoint-every', type=int, default=1000,
+                   help='write a resumable checkpoint every N training steps (0 disables periodic saves)')
+    p.add_argument('--eval-every', type=int, default=0,
+                   help='evaluate on a dev subsample every N steps instead of the full dev set every epoch')
+    p.add_argument('--eval-subsample', type=int, default=500,
+                   help='number of dev sentences in the stratified subsample used with --eval-every')
+    p.add_argument('--parallel-eval', action='store_true',
+                   help='run full dev evaluations in a separate process on a weight snapshot')
+    p.add_argument('--seed', type=int, default=None,
+                   help='seed embedding init, weight init and shuffling, and use deterministic torch kernels')
+    p.add_argument('--threads', type=int, default=None, help='number of torch intra-op threads')
+    p.add_argument('--device', default=None, help='device to train on (default: cuda if available, else cpu)')
+    p.add_argument('--dtype', choices=DTYPES, default='float32', help='floating point type of the model parameters')
+    p.add_argument('--metrics-every', type=int, default=100,
+                   help='record throughput, step timing and memory every N steps (0 disables)')
+    p.add_argument('--metrics-file', default=None,
+                   help='telemetry output: JSONL, or Prometheus text if it ends in .prom '
+                        '(default: metrics.jsonl in the run directory)')
+    p.add_argument('--check-determinism', action='store_true',
+                   help='after training, check that dev parses are identical across batch sizes and thread counts')
+    _add_optimization_arguments(p)
+    p.add_argument('--batch-size', type=int, default=REFERENCE_BATCH_SIZE, help='examples per minibatch')
+    p.add_argument('--accumulation-steps', type=int, default=1,
+                   help='minibatches accumulated into one optimizer step (effective batch = batch size x steps)')
+    p.set_defaults(func=cmd_train)
+
+    settings = lambda s: [tuple(int(x) for x in (b.split('x') + ['1'])[:2]) for b in s.split(',')]
+    p = subparsers.add_parser('batch-sweep',
+                              help='compare training throughput and dev UAS across (effective) batch sizes')
+    p.add_argument('-d', '--debug', action='store_true', help='whether to use the reduced data set')
+    p.add_argument('--settings', type=settings, default=settings('50,500,2000,500x4'),
+                   help='comma-separated BATCH or BATCHxACCUMULATION_STEPS settings')
+    p.add_argument('--seed', type=int, default=0, help='seed shared by all settings')
+    p.add_argument('--threads', type=int, default=None, help='number of torch intra-op threads')
+    p.add_argument('--device', default=None, help='device to train on (default: cuda if available, else cpu)')
+    p.add_argument('--dtype', choices=DTYPES, default='float32', help='floating point type of the model parameters')
+    _add_optimization_arguments(p, n_epochs=3, lr_scaling='sqrt', lr_schedule='linear')
+    p.set_defaults(func=cmd_batch_sweep)
+
+    p = subparsers.add_parser('eval', help='report the UAS of a trained parser on a CoNLL file')
+    p.add_argument('model_dir', help='directory with parser.pkl and model.weights written by train')
+    p.add_argument('conll', nargs='?', default=None, help='CoNLL file (default: the configured test file)')
+    p.add_argument('--batch-size', type=int, default=5000, help='parses per decoding minibatch')
+    p.add_argument('--device', default='cpu', help='device to run the model on')
+    p.set_defaults(func=cmd_eval)
+
+    import parse_conll
+    p = subparsers.add_parser('parse', help='parse a CoNLL or tagged-text file to CoNLL-U')
+    parse_conll.add_arguments(p)
+    p.set_defaults(func=cmd_parse, validate=functools.partial(parse_conll.check_arguments, p))
+
+    int_list = lambda s: [int(x) for x in s.split(',')]
+    p = subparsers.add_parser('bench', help='measure decoding throughput of a trained parser')
+    p.add_argument('model_dir', help='directory with parser.pkl and model.weights written by train')
+    p.add_argument('conll', help='CoNLL file to parse')
+    p.add_argument('--batch-sizes', type=int_list, default=[1000, 5000], help='comma-separated minibatch sizes')
+    p.add_argument('--pipeline-groups', type=int_list, default=[1, 2], help='comma-separated pipeline group counts')
+    p.add_argument('--repeat', type=int, default=3, help='runs per setting; the fastest is reported')
+    p.add_argument('--max-sentences', type=int, default=None, help='only parse the first N sentences')
+    p.add_argument('--threads', type=int, default=None, help='number of torch intra-op threads')
+    p.add_argument('--device', default='cpu', help='device to run the model on')
+    p.add_argument('--check-determinism', action='store_true',
+                   help='also check that all settings produce identical parses')
+    p.set_defaults(func=cmd_bench)
+
+    p = subparsers.add_parser('export-numpy', help='export a trained parser for the torch-free NumPy runtime')
+    p.add_argument('model_dir', help='directory with parser.pkl and model.weights written by train')
+    p.add_argument('output_dir', help='directory for parser.pkl and the .npy weight arrays')
+    p.add_argument('--check', metavar='CONLL', default=None,
+                   help='check that the exported model parses this CoNLL file like the torch model')
+    p.set_defaults(func=cmd_export_numpy)
+
+    p = subparsers.add_parser('compact', help='prune the word vocabulary of a trained parser and its embeddings')
+    p.add_argument('model_dir', help='directory with parser.pkl and model.weights written by train')
+    p.add_argument('output_dir', help='directory for the compacted parser.pkl and model.weights')
+    p.add_argument('--min-count', type=int, default=1, help='drop words seen fewer than N times in training')
+    p.add_argument('--max-vocab', type=int, default=None, help='keep at most the N most frequent words')
+    p.set_defaults(func=cmd_compact)
+
+    p = subparsers.add_parser('stats', help='print sentence and token statistics of CoNLL files')
+    p.add_argument('conll', nargs='+', help='CoNLL files')
+    p.set_defaults(func=cmd_stats)
+
+    p = subparsers.add_parser('index', help='build the sentence byte-offset index of CoNLL files')
+    p.add_argument('conll', nargs='+', help='CoNLL files; each index is written next to its file')
+    p.add_argument('--shards', type=int, default=1, help='also print the ranges of this many shards')
+    p.set_defaults(func=cmd_index)
+
+    p = subparsers.add_parser('vocab', help='inspect the vocabulary of a trained parser')
+    p.add_argument('model_dir', help='directory with parser.pkl written by train')
+    p.add_argument('--top', type=int, default=20, help='number of most frequent words to list')
+    p.set_defaults(func=cmd_vocab)
+    return argparser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # `python run.py [-d] ...` keeps training, as it did before there were subcommands.
+    if len(argv) == 0 or (argv[0].startswith('-') and argv[0] not in ('-h', '--help')):
+        argv = ['train'] + argv
+    args = build_arg_parser().parse_args(argv)
+    if getattr(args, 'validate', None) is not None:
+        args.validate(args)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+checkpoint_utils.py: Resumable training checkpoints written off the training thread.
+"""
+
+import copy
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def get_rng_state():
+    """Captures the python, numpy and torch RNG states.
+
+    The numpy key array is stored as a plain list so the checkpoint only holds
+    tensors and primitive types.
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {'python': random.getstate(),
+            'numpy': (name, keys.tolist(), pos, has_gauss, cached_gaussian),
+            'torch': torch.get_rng_state()}
+
+
+def set_rng_state(state):
+    """Restores RNG states captured by `get_rng_state`."""
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+
+
+def snapshot_training_state(model, optimizer, epoch, step, rng_state, best_dev_UAS, scheduler=None,
+                            best_subsample_UAS=0):
+    """Copies everything needed to resume training into host memory.
+
+    @param model (nn.Module): model being trained
+    @param optimizer (nn.Optimizer): its optimizer
+    @param epoch (int): epoch to resume in
+    @param step (int): number of minibatches of `epoch` already done
+    @param rng_state (dict): RNG state at the start of `epoch` (see `get_rng_state`),
+                             so the epoch's shuffling can be replayed on resume
+    @param best_dev_UAS (float): best dev UAS seen so far
+    @param scheduler (LRScheduler): learning rate schedule of `optimizer`, if any
+    @param best_subsample_UAS (float): best dev subsample UAS seen so far (with step-based evaluation)
+
+    @return state (dict): snapshot that no longer shares storage with the live model
+    """
+    return {'model': {k: v.detach().cpu().clone() for k, v in model.state_dict().items()},
+            'optimizer': copy.deepcopy(optimizer.state_dict()),
+            'epoch': epoch,
+            'step': step,
+            'rng_state': copy.deepcopy(rng_state),
+            'best_dev_UAS': best_dev_UAS,
+            'best_subsample_UAS': best_subsample_UAS,
+            'scheduler': copy.deepcopy(scheduler.state_dict()) if scheduler is not None else None}
+
+
+def load_checkpoint(path):
+    return torch.load(path, map_location='cpu')
+
+
+class AsyncCheckpointer(object):
+    """Writes snapshots to disk on a background thread.
+
+    `save` only enqueues the (already copied) object, so training is not blocked
+    by serialization or disk IO. Files are written to a temporary name and moved
+    into place so a crash mid-write never leaves a truncated checkpoint.
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            obj, path = item
+            try:
+                tmp_path = path + '.tmp'
+                torch.save(obj, tmp_path)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def save(self, obj, path):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((obj, path))
+
+    def close(self):
+        """Waits for pending writes to finish and stops the writer thread."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+conll_index.py: Byte-offset sentence index over CoNLL files.
+
+The index records where every sentence of a CoNLL file starts, so sentence i can be read with
+one seek, a random subsample without scanning the file, and contiguous shards of the file can be
+handed to parallel workers. It is built by one pass over the file and saved next to it as
+`<file>.idx`; it is rebuilt when the file's size or modification time changes.
+
+Sentence boundaries are those of read_conll. Sentence i spans bytes offsets[i]:offsets[i + 1],
+from the end of the previous sentence (including any comment or blank lines before it) through
+the line that ends it.
+"""
+
+import os
+import pickle
+
+import numpy as np
+
+from .parser_utils import read_conll_lines, iter_conll
+
+
+class ConllIndex(object):
+    """Sentence offsets of a CoNLL file.
+
+    @param path (str): CoNLL file
+    @param index_path (str): where the index is stored (default: `path` + '.idx'); if it
+                             cannot be written, the index is only kept in memory
+    """
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + '.idx'
+        stat = os.stat(path)
+        self.signature = (stat.st_size, stat.st_mtime_ns)
+        self.offsets = self._load()
+        if self.offsets is None:
+            self.offsets = self._build()
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return state['offsets'] if state.get('signature') == self.signature else None
+
+    def _save(self):
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({'signature': self.signature, 'offsets': self.offsets}, f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            pass
+
+    def _build(self):
+        offsets = [0]
+        n_words = 0
+        position = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                position += len(line)
+                sp = line.strip().split(b'\t')
+                if len(sp) == 10:
+                    if b'-' not in sp[0]:
+                        n_words += 1
+                elif n_words > 0:
+                    offsets.append(position)
+                    n_words = 0
+        if n_words > 0:
+            offsets.append(position)
+        return np.array(offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lines(self, start=0, end=None):
+        """Yields the lines of sentences [start, end) after a single seek.
+
+        Lines are read as they are consumed, so a shard is streamed rather than held in
+        memory; the file stays open until the iterator is exhausted or closed.
+        """
+        end = len(self) if end is None else end
+        if end <= start:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(int(self.offsets[start]))
+            remaining = int(self.offsets[end] - self.offsets[start])
+            while remaining > 0:
+                line = f.readline()
+                if not line:
+                    break
+                remaining -= len(line)
+                yield line.decode('utf-8')
+
+    def read(self, indices, lowercase=False):
+        """Reads the sentences at `indices` (in that order) as read_conll examples."""
+        indices = list(indices)
+        examples = [None] * len(indices)
+        # Runs of consecutive indices are read with a single seek.
+        order = sorted(range(len(indices)), key=lambda k: indices[k])
+        k = 0
+        while k < len(order):
+            run = k
+            while run + 1 < len(order) and indices[order[run + 1]] == indices[order[run]] + 1:
+                run += 1
+            start, end = indices[order[k]], indices[order[run]] + 1
+            for j, ex in zip(order[k:run + 1], read_conll_lines(self.lines(start, end), lowercase)):
+                examples[j] = ex
+            k = run + 1
+        return examples
+
+    def __getitem__(self, i):
+        return self.read([i])[0]
+
+    def sample(self, n, seed=0, lowercase=False):
+        """Reads a uniform random subsample of `n` sentences, in file order."""
+        rng = np.random.RandomState(seed)
+        indices = np.sort(rng.choice(len(self), min(n, len(self)), replace=False))
+        return self.read(indices.tolist(), lowercase)
+
+    def shards(self, k):
+        """Splits the file into `k` contiguous sentence ranges of about equal size in bytes.
+
+        @return shards (list of (int, int)): [start, end) sentence indices of every shard
+        """
+        targets = self.offsets[-1] * np.arange(1, k) / float(k)
+        bounds = [0] + np.searchsorted(self.offsets, targets).tolist() + [len(self)]
+        bounds = np.clip(bounds, 0, len(self)).tolist()
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def iter_shard(self, i, k, lowercase=False):
+        """Streams shard `i` of `k` like iter_conll, reading only that part of the file."""
+        start, end = self.shards(k)[i]
+        return iter_conll(self.lines(start, end), lowercase=lowercase)
@@ -11,7 +11,7 @@ import time
 import numpy as np
 
 
-def get_minibatches(data, minibatch_size, shuffle=True):
+def get_minibatches(data, minibatch_size, shuffle=True, rng=None):
     """
     Iterates through the provided data one minibatch at at time. You can use this function to
     iterate through data in minibatches as follows:
@@ -30,6 +30,7 @@ def get_minibatches(data, minibatch_size, shuffle=True):
             - a list where each element is either a list or numpy array
         minibatch_size: the maximum number of items in a minibatch
         shuffle: whether to randomize the order of returned data
+        rng: np.random.RandomState to shuffle with (defaults to the global numpy RNG)
     Returns:
         minibatches: the return value depends on data:
             - If data is a list/array it yields the next minibatch of data.
@@ -42,13 +43,52 @@ def get_minibatches(data, minibatch_size, shuffle=True):
     data_size = len(data[0]) if list_data else len(data)
     indices = np.arange(data_size)
     if shuffle:
-        np.random.shuffle(indices)
+        (np.random if rng is None else rng).shuffle(indices)
     for minibatch_start in np.arange(0, data_size, minibatch_size):
         minibatch_indices = indices[minibatch_start:minibatch_start + minibatch_size]
         yield [_minibatch(d, minibatch_indices) for d in data] if list_data \
             else _minibatch(data, minibatch_indices)
 
 
+def run_stages(stages, max_workers=4):
+    """
+    Runs a graph of dependent stages on a thread pool, starting every stage as soon as the
+    stages it depends on have finished, so that independent stages overlap.
+
+    Args:
+        stages: dict mapping a stage name to (function, names of the stages it depends on); the
+            function is called with the results of those stages as positional arguments
+        max_workers: maximum number of stages running at a time
+    Returns:
+        results: dict mapping every stage name to the return value of its function
+        timings: dict mapping every stage name to its (start, end) in seconds since the call
+    """
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+    t0 = time.time()
+
+    def timed(fn, args):
+        start = time.time() - t0
+        result = fn(*args)
+        return result, (start, time.time() - t0)
+
+    results, timings = {}, {}
+    pending = dict(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            for name in [n for n, (_, deps) in pending.items() if all(d in results for d in deps)]:
+                fn, deps = pending.pop(name)
+                running[executor.submit(timed, fn, [results[d] for d in deps])] = name
+            if len(running) == 0:
+                raise ValueError("stages with unmet dependencies: {}".format(sorted(pending)))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name], timings[name] = future.result()
+    return results, timings
+
+
 def _minibatch(data, minibatch_idx):
     return data[minibatch_idx] if type(data) is np.ndarray else [data[i] for i in minibatch_idx]
 
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+instance_store.py: Incremental cache of gold-configuration training instances.
+
+Running `Parser.create_instances` over a large corpus is slow, and the corpus changes a little at a
+time (annotated sentences are appended, bad ones removed). The store keeps one block of instances
+per sentence, keyed by a hash of the sentence's content, so only new sentences are processed.
+
+Blocks do not depend on the vocabulary: word and POS features are stored as positions in the
+sentence (-1 for NULL) and turned into ids with the current vocabulary when instances are
+assembled. Label features and labeled transitions do depend on the label ids, so the store is
+rebuilt from scratch if those change.
+"""
+
+import copy
+import hashlib
+import os
+import pickle
+
+import numpy as np
+
+
+def sentence_key(ex):
+    """Content hash of a sentence as returned by read_conll."""
+    content = repr((ex['word'], ex['pos'], ex['head'], ex['label']))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class InstanceStore(object):
+    """Per-sentence blocks of training instances persisted in a single file.
+
+    Each block is (positions, legal_labels, gold) for every configuration of the sentence's
+    oracle derivation: positions is (n_configs, n_features) int32, with word/POS columns holding
+    token positions and label columns holding label ids; sentences the oracle cannot derive
+    (non-projective trees) have empty blocks, as create_instances skips them.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fingerprint = None
+        self.blocks = {}
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            self.fingerprint, self.blocks = state['fingerprint'], state['blocks']
+
+    @staticmethod
+    def parser_fingerprint(parser):
+        labels = sorted((t, i) for (t, i) in parser.tok2id.items() if t.startswith('<l>:'))
+        return parser.n_features, parser.unlabeled, parser.use_pos, parser.use_dep, tuple(labels)
+
+    def _position_parser(self, parser):
+        """A copy of `parser` whose NULL tokens are -1, so that extract_features on an example
+        whose words and tags are their own positions yields positions."""
+        position_parser = copy.copy(parser)
+        position_parser.NULL = position_parser.P_NULL = position_parser.L_NULL = -1
+        return position_parser
+
+    def _build_block(self, position_parser, vec_ex):
+        n = len(vec_ex['word'])
+        ex = {'word': list(range(n)), 'pos': list(range(n)),
+              'head': vec_ex['head'], 'label': vec_ex['label']}
+        instances = position_parser.create_instances([ex])
+        n_features = position_parser.n_features
+        positions = np.array([inst[0] for inst in instances], dtype=np.int32).reshape(-1, n_features)
+        legal = np.array([inst[1] for inst in instances], dtype=np.int8).reshape(-1, position_parser.n_trans)
+        gold = np.array([inst[2] for inst in instances], dtype=np.int32)
+        return positions, legal, gold
+
+    def update(self, parser, examples, vec_examples):
+        """Brings the store in line with `examples`: builds blocks for new sentences and drops
+        blocks of sentences that are no longer present.
+
+        @param parser (Parser): parser whose configuration and label ids the instances follow
+        @param examples (list of dict): sentences as returned by read_conll (used for the keys)
+        @param vec_examples (list of dict): the same sentences vectorized by `parser`
+
+        @return keys (list of str): block key of every example, in order
+        """
+        fingerprint = self.parser_fingerprint(parser)
+        if fingerprint != self.fingerprint:
+            self.fingerprint, self.blocks = fingerprint, {}
+
+        keys = [sentence_key(ex) for ex in examples]
+        position_parser = self._position_parser(parser)
+        n_new = 0
+        for key, vec_ex in zip(keys, vec_examples):
+            if key not in self.blocks:
+                self.blocks[key] = self._build_block(position_parser, vec_ex)
+                n_new += 1
+        live = set(keys)
+        n_removed = 0
+        for key in [k for k in self.blocks if k not in live]:
+            del self.blocks[key]
+            n_removed += 1
+        if n_new > 0 or n_removed > 0:
+            self.save()
+        print("instance store: {} sentences, {} new, {} removed".format(len(keys), n_new, n_removed))
+        return keys
+
+    def instances(self, parser, keys, vec_examples):
+        """Assembles training instances in the format of Parser.create_instances by
+        concatenating the blocks of `keys` in order, mapping positions to the ids of `vec_examples`.
+        """
+        n_word = 18
+        n_pos = 18 if parser.use_pos else 0
+        all_instances = []
+        for key, ex in zip(keys, vec_examples):
+            positions, legal, gold = self.blocks[key]
+            if len(gold) == 0:
+                continue
+            features = positions.copy()
+            word = np.array(ex['word'], dtype=np.int32)
+            pos = np.array(ex['pos'], dtype=np.int32)
+            columns = ((slice(0, n_word), word, parser.NULL),
+                       (slice(n_word, n_word + n_pos), pos, parser.P_NULL))
+            for cols, ids, null in columns:
+                block = positions[:, cols]
+                features[:, cols] = np.where(block < 0, null, ids[np.maximum(block, 0)])
+            label_cols = features[:, n_word + n_pos:]
+            label_cols[label_cols < 0] = parser.L_NULL
+            all_instances += [(f, l, g) for (f, l, g) in
+                              zip(features.tolist(), legal.tolist(), gold.tolist())]
+        return all_instances
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'fingerprint': self.fingerprint, 'blocks': self.blocks}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+metrics_utils.py: Throughput, step timing and memory telemetry for the training loop.
+"""
+
+import json
+import os
+import resource
+import sys
+import time
+
+PHASES = ('batch', 'forward', 'backward', 'optimizer', 'callback')
+# CUDA events held before they are resolved, so a long window (or log_every=0) stays bounded.
+MAX_PENDING_EVENTS = 1000
+
+
+def rss_bytes():
+    """Current resident set size of this process, or the peak if the current one is unavailable."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class TrainingMetrics(object):
+    """Accumulates per-phase step timings and emits a record every `log_every` steps.
+
+    A step is one minibatch; with gradient accumulation several steps make up one optimizer
+    update, and `global_step` counts the updates. The training loop calls `start` once before
+    its first step, `lap(phase)` after each phase of a step (the time since the previous lap is
+    charged to `phase`) and `end_step` when the step is done. Each record holds examples/sec
+    (not counting the 'callback' phase), mean milliseconds per step for every phase and memory
+    use over the steps since the previous record; it is printed as a progress line and, with
+    `path`, appended to a JSONL file or, if `path` ends in `.prom`, written as a Prometheus text
+    file (replaced on every record, for a node-exporter style scraper).
+
+    @param log_every (int): steps between records; 0 only records on `flush`
+    @param path (str): output file, or None to only print progress lines
+    @param device (torch.device or str): device of the model; on CUDA each lap records an event
+                                         on the current stream instead of reading the host clock,
+                                         so asynchronous kernels are charged to their phase without
+                                         synchronizing the device, which is only waited for when a
+                                         record is emitted
+    """
+    def __init__(self, log_every=100, path=None, device='cpu'):
+        self.log_every = log_every
+        self.path = path
+        self.cuda = str(device).startswith('cuda')
+        self.prometheus = path is not None and path.endswith('.prom')
+        if path is not None and not self.prometheus:
+            open(path, 'a').close()
+        self.epoch = 0
+        self.global_step = 0
+        self._events = []
+        self._reset_window()
+        self._last = self._now()
+
+    def _reset_window(self):
+        self.phase_seconds = dict.fromkeys(PHASES, 0.)
+        self.window_steps = 0
+        self.window_examples = 0
+        self.window_loss = 0.
+
+    def _now(self):
+        """A host clock reading, or on CUDA an event recorded on the current stream."""
+        if not self.cuda:
+            return time.perf_counter()
+        import torch
+        event = torch.cuda.Event(enable_timing=True)
+        event.record()
+        return event
+
+    def _collect_events(self):
+        """Charges the CUDA events recorded since the last record to their phases."""
+        if not self._events:
+            return
+        self._events[-1][1].synchronize()
+        for phase, event in self._events:
+            self.phase_seconds[phase] += self._last.elapsed_time(event) / 1000.
+            self._last = event
+        self._events = []
+
+    def start(self):
+        self._events = []
+        self._last = self._now()
+
+    def lap(self, phase):
+        now = self._now()
+        if self.cuda:
+            self._events.append((phase, now))
+        else:
+            self.phase_seconds[phase] += now - self._last
+            self._last = now
+
+    def end_step(self, step, n_examples, loss, update=True):
+        """Records a finished step of `n_examples` examples (`step` is the 1-based step in the epoch).
+
+        @param update (bool): whether the step ended with an optimizer update
+        """
+        if update:
+            self.global_step += 1
+        self.window_steps += 1
+        self.window_examples += n_examples
+        self.window_loss += loss
+        if self.log_every > 0 and self.window_steps >= self.log_every:
+            self.emit(step)
+        elif len(self._events) >= MAX_PENDING_EVENTS:
+            self._collect_events()
+
+    def flush(self, step):
+        """Emits a record for the steps since the last one, if any (e.g. at the end of an epoch)."""
+        if self.window_steps > 0:
+            self.emit(step)
+
+    def emit(self, step):
+        self._collect_events()
+        # Callbacks (dev evaluations, checkpoints) are reported in step_ms but are not training time.
+        seconds = sum(t for p, t in self.phase_seconds.items() if p != 'callback')
+        record = {
+            'time': time.time(),
+            'epoch': self.epoch + 1,
+            'step': step,
+            'global_step': self.global_step,
+            'loss': self.window_loss / self.window_steps,
+            'examples_per_sec': self.window_examples / max(seconds, 1e-9),
+            'step_ms': {p: 1000. * s / self.window_steps for p, s in self.phase_seconds.items()},
+            'rss_bytes': rss_bytes(),
+            'peak_rss_bytes': peak_rss_bytes(),
+        }
+        if self.cuda:
+            import torch
+            record['cuda_allocated_bytes'] = torch.cuda.memory_allocated()
+            record['cuda_peak_allocated_bytes'] = torch.cuda.max_memory_allocated()
+        self._reset_window()
+        print(self.format_progress(record))
+        if self.path is not None:
+            self.write(record)
+
+    @staticmethod
+    def format_progress(record):
+        ms = record['step_ms']
+        line = "epoch {} step {:>6} | loss {:.4f} | {:>8.0f} ex/s | ms/step batch {:.2f} fwd {:.2f} " \
+               "bwd {:.2f} opt {:.2f} callback {:.2f} | rss {:.0f} MB".format(
+                   record['epoch'], record['step'], record['loss'], record['examples_per_sec'], ms['batch'],
+                   ms['forward'], ms['backward'], ms['optimizer'], ms['callback'], record['rss_bytes'] / 2 ** 20)
+        if 'cuda_allocated_bytes' in record:
+            line += " | cuda {:.0f} MB".format(record['cuda_allocated_bytes'] / 2 ** 20)
+        return line
+
+    def write(self, record):
+        if not self.prometheus:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            return
+        lines = []
+
+        def gauge(name, value, help_text, labels=None):
+            if labels is None:
+                lines.extend(['# HELP parser_train_{} {}'.format(name, help_text),
+                              '# TYPE parser_train_{} gauge'.format(name)])
+                lines.append('parser_train_{} {}'.format(name, value))
+            else:
+                lines.append('parser_train_{}{{{}}} {}'.format(
+                    name, ','.join('{}="{}"'.format(k, v) for k, v in labels.items()), value))
+
+        gauge('epoch', record['epoch'], 'Current epoch (1-based).')
+        gauge('global_step', record['global_step'], 'Optimizer steps taken in this run.')
+        gauge('loss', record['loss'], 'Mean training loss over the last window.')
+        gauge('examples_per_second', record['examples_per_sec'], 'Training throughput over the last window.')
+        lines.extend(['# HELP parser_train_step_seconds Mean seconds per step spent in each phase.',
+                      '# TYPE parser_train_step_seconds gauge'])
+        for phase, ms in record['step_ms'].items():
+            gauge('step_seconds', ms / 1000., None, {'phase': phase})
+        gauge('rss_bytes', record['rss_bytes'], 'Resident set size of the training process.')
+        gauge('peak_rss_bytes', record['peak_rss_bytes'], 'Peak resident set size of the training process.')
+        if 'cuda_allocated_bytes' in record:
+            gauge('cuda_allocated_bytes', record['cuda_allocated_bytes'], 'CUDA memory allocated by tensors.')
+            gauge('cuda_peak_allocated_bytes', record['cuda_peak_allocated_bytes'],
+                  'Peak CUDA memory allocated by tensors.')
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.path)
@@ -8,13 +8,17 @@ Sahil Chopra <schopra8@stanford.edu>
 
 import time
 import os
+import copy
+import inspect
 import logging
-from collections import Counter
-from . general_utils import get_minibatches
+import pickle
+import random
+import threading
+from collections import Counter, OrderedDict
 from parser_transitions import minibatch_parse
 
-import torch
-import numpy as np
+# numpy and torch are imported inside the functions that use them, so that tools which only
+# read CoNLL files or vocabularies do not pay for loading them.
 
 P_PREFIX = '<p>:'
 L_PREFIX = '<l>:'
@@ -36,12 +40,41 @@ class Config(object):
     dev_file = 'dev.conll'
     test_file = 'test.conll'
     embedding_file = 'en-cw.txt'
+    # Word vocabulary limits: keep at most `max_vocab` words seen at least `min_word_freq`
+    # times in training; with `keep_pretrained`, rarer words that have a pretrained vector
+    # are kept as well.
+    max_vocab = None
+    min_word_freq = 1
+    keep_pretrained = True
+    # Number of parsed sentences kept in the Parser's LRU parse cache (0 disables it).
+    parse_cache_size = 0
+    # Number of thread-pipelined decoding groups used by Parser.parse (see minibatch_parse).
+    pipeline_groups = 1
+    # Sentences longer than `long_sentence_threshold` tokens are decoded in a separate queue with
+    # their own minibatch size and optional per-sentence budgets of decoding seconds and of
+    # transitions (see minibatch_parse). Parses over budget are completed right-branching.
+    long_sentence_threshold = None
+    long_sentence_batch_size = 64
+    long_sentence_time_budget = None
+    long_sentence_max_steps = None
+    # Path of an incremental per-sentence instance store for the training data (see
+    # utils/instance_store.py); None runs create_instances over the whole training set.
+    instance_store = None
+    # Stages of load_and_preprocess_data that may run at a time, and whether the file-reading
+    # stages run in worker processes rather than threads.
+    load_workers = 4
+    load_processes = False
 
 
 class Parser(object):
     """Contains everything needed for transition-based dependency parsing except for the model"""
 
-    def __init__(self, dataset):
+    def __init__(self, dataset, pretrained_vocab=None):
+        """
+        @param dataset (list of dict): training examples as returned by read_conll
+        @param pretrained_vocab (container of str): words with pretrained embeddings, used to
+                                                    retain rare words under the vocabulary cutoffs
+        """
         root_labels = list([l for ex in dataset
                            for (h, l) in zip(ex['head'], ex['label']) if h == 0])
         counter = Counter(root_labels)
@@ -49,9 +82,9 @@ class Parser(object):
             logging.info('Warning: more than one root label')
             logging.info(counter)
         self.root_label = counter.most_common()[0][0]
-        deprel = [self.root_label] + list(set([w for ex in dataset
-                                               for w in ex['label']
-                                               if w != self.root_label]))
+        deprel = [self.root_label] + sorted(set([w for ex in dataset
+                                                 for w in ex['label']
+                                                 if w != self.root_label]))
         tok2id = {L_PREFIX + l: i for (i, l) in enumerate(deprel)}
         tok2id[L_PREFIX + NULL] = self.L_NULL = len(tok2id)
 
@@ -81,18 +114,69 @@ class Parser(object):
         tok2id[P_PREFIX + ROOT] = self.P_ROOT = len(tok2id)
 
         # logging.info('Build dictionary for words.')
-        tok2id.update(build_dict([w for ex in dataset for w in ex['word']],
-                                  offset=len(tok2id)))
+        self.word_counts = Counter(w for ex in dataset for w in ex['word'])
+        keep = None
+        if config.keep_pretrained and pretrained_vocab is not None:
+            keep = set(w for w in self.word_counts if w in pretrained_vocab or w.lower() in pretrained_vocab)
+        self.tok2id = tok2id
+        self._set_word_vocab(build_dict(self.word_counts, n_max=config.max_vocab,
+                                        min_count=config.min_word_freq, keep=keep))
+
+        self.n_features = 18 + (18 if config.use_pos else 0) + (12 if config.use_dep else 0)
+        self.parse_cache = ParseCache(config.parse_cache_size) if config.parse_cache_size > 0 else None
+        self.pipeline_groups = config.pipeline_groups
+        self.long_sentence_threshold = config.long_sentence_threshold
+        self.long_sentence_batch_size = config.long_sentence_batch_size
+        self.long_sentence_time_budget = config.long_sentence_time_budget
+        self.long_sentence_max_steps = config.long_sentence_max_steps
+        self.decode_stats = Counter()
+
+    def __setstate__(self, state):
+        # Parsers pickled before a decoding setting existed get its Config default.
+        config = Config()
+        self.__dict__.update({'parse_cache': None,
+                              'pipeline_groups': config.pipeline_groups,
+                              'long_sentence_threshold': config.long_sentence_threshold,
+                              'long_sentence_batch_size': config.long_sentence_batch_size,
+                              'long_sentence_time_budget': config.long_sentence_time_budget,
+                              'long_sentence_max_steps': config.long_sentence_max_steps,
+                              'decode_stats': Counter()})
+        self.__dict__.update(state)
+
+    def _set_word_vocab(self, word2id):
+        """Replaces the word entries of tok2id with `word2id` (numbered from 0), placed after the
+        label and POS entries and followed by the UNK/NULL/ROOT word tokens."""
+        tok2id = {t: i for (t, i) in self.tok2id.items() if t.startswith(L_PREFIX) or t.startswith(P_PREFIX)}
+        offset = len(tok2id)
+        tok2id.update({w: i + offset for (w, i) in word2id.items()})
         tok2id[UNK] = self.UNK = len(tok2id)
         tok2id[NULL] = self.NULL = len(tok2id)
         tok2id[ROOT] = self.ROOT = len(tok2id)
 
         self.tok2id = tok2id
         self.id2tok = {v: k for (k, v) in tok2id.items()}
-
-        self.n_features = 18 + (18 if config.use_pos else 0) + (12 if config.use_dep else 0)
         self.n_tokens = len(tok2id)
 
+    def prune_vocabulary(self, n_max=None, min_count=1, keep=None):
+        """Shrinks the word vocabulary in place, e.g. to compact a trained model.
+
+        Words that fall outside the new cutoffs map to UNK from now on. Label and POS ids
+        are unchanged; word ids are renumbered contiguously.
+
+        @param n_max (int): maximum number of words to keep
+        @param min_count (int): minimum training frequency of a kept word
+        @param keep (container of str): words kept regardless of `min_count`
+
+        @return index (ndarray): old token id for every new token id, so that
+                                 `embeddings[index]` is the compacted embedding table
+        """
+        import numpy as np
+
+        old_tok2id = self.tok2id
+        counts = Counter({w: c for (w, c) in self.word_counts.items() if w in old_tok2id})
+        self._set_word_vocab(build_dict(counts, n_max=n_max, min_count=min_count, keep=keep))
+        return np.array([old_tok2id[self.id2tok[i]] for i in range(self.n_tokens)], dtype=np.int64)
+
     def vectorize(self, examples):
         vec_examples = []
         for ex in examples:
@@ -111,20 +195,26 @@ class Parser(object):
         if stack[0] == "ROOT":
             stack[0] = 0
 
+        # Index the arcs by head once instead of scanning them for every child lookup.
+        children = {}
+        for arc in arcs:
+            children.setdefault(arc[0], []).append(arc[1])
+
         def get_lc(k):
-            return sorted([arc[1] for arc in arcs if arc[0] == k and arc[1] < k])
+            return sorted([c for c in children.get(k, ()) if c < k])
 
         def get_rc(k):
-            return sorted([arc[1] for arc in arcs if arc[0] == k and arc[1] > k],
+            return sorted([c for c in children.get(k, ()) if c > k],
                           reverse=True)
 
+        word, pos, label = ex['word'], ex['pos'], ex['label']
         p_features = []
         l_features = []
-        features = [self.NULL] * (3 - len(stack)) + [ex['word'][x] for x in stack[-3:]]
-        features += [ex['word'][x] for x in buf[:3]] + [self.NULL] * (3 - len(buf))
+        features = [self.NULL] * (3 - len(stack)) + [word[x] for x in stack[-3:]]
+        features += [word[x] for x in buf[:3]] + [self.NULL] * (3 - len(buf))
         if self.use_pos:
-            p_features = [self.P_NULL] * (3 - len(stack)) + [ex['pos'][x] for x in stack[-3:]]
-            p_features += [ex['pos'][x] for x in buf[:3]] + [self.P_NULL] * (3 - len(buf))
+            p_features = [self.P_NULL] * (3 - len(stack)) + [pos[x] for x in stack[-3:]]
+            p_features += [pos[x] for x in buf[:3]] + [self.P_NULL] * (3 - len(buf))
 
         for i in range(2):
             if i < len(stack):
@@ -134,28 +224,28 @@ class Parser(object):
                 llc = get_lc(lc[0]) if len(lc) > 0 else []
                 rrc = get_rc(rc[0]) if len(rc) > 0 else []
 
-                features.append(ex['word'][lc[0]] if len(lc) > 0 else self.NULL)
-                features.append(ex['word'][rc[0]] if len(rc) > 0 else self.NULL)
-                features.append(ex['word'][lc[1]] if len(lc) > 1 else self.NULL)
-                features.append(ex['word'][rc[1]] if len(rc) > 1 else self.NULL)
-                features.append(ex['word'][llc[0]] if len(llc) > 0 else self.NULL)
-                features.append(ex['word'][rrc[0]] if len(rrc) > 0 else self.NULL)
+                features.append(word[lc[0]] if len(lc) > 0 else self.NULL)
+                features.append(word[rc[0]] if len(rc) > 0 else self.NULL)
+                features.append(word[lc[1]] if len(lc) > 1 else self.NULL)
+                features.append(word[rc[1]] if len(rc) > 1 else self.NULL)
+                features.append(word[llc[0]] if len(llc) > 0 else self.NULL)
+                features.append(word[rrc[0]] if len(rrc) > 0 else self.NULL)
 
                 if self.use_pos:
-                    p_features.append(ex['pos'][lc[0]] if len(lc) > 0 else self.P_NULL)
-                    p_features.append(ex['pos'][rc[0]] if len(rc) > 0 else self.P_NULL)
-                    p_features.append(ex['pos'][lc[1]] if len(lc) > 1 else self.P_NULL)
-                    p_features.append(ex['pos'][rc[1]] if len(rc) > 1 else self.P_NULL)
-                    p_features.append(ex['pos'][llc[0]] if len(llc) > 0 else self.P_NULL)
-                    p_features.append(ex['pos'][rrc[0]] if len(rrc) > 0 else self.P_NULL)
+                    p_features.append(pos[lc[0]] if len(lc) > 0 else self.P_NULL)
+                    p_features.append(pos[rc[0]] if len(rc) > 0 else self.P_NULL)
+                    p_features.append(pos[lc[1]] if len(lc) > 1 else self.P_NULL)
+                    p_features.append(pos[rc[1]] if len(rc) > 1 else self.P_NULL)
+                    p_features.append(pos[llc[0]] if len(llc) > 0 else self.P_NULL)
+                    p_features.append(pos[rrc[0]] if len(rrc) > 0 else self.P_NULL)
 
                 if self.use_dep:
-                    l_features.append(ex['label'][lc[0]] if len(lc) > 0 else self.L_NULL)
-                    l_features.append(ex['label'][rc[0]] if len(rc) > 0 else self.L_NULL)
-                    l_features.append(ex['label'][lc[1]] if len(lc) > 1 else self.L_NULL)
-                    l_features.append(ex['label'][rc[1]] if len(rc) > 1 else self.L_NULL)
-                    l_features.append(ex['label'][llc[0]] if len(llc) > 0 else self.L_NULL)
-                    l_features.append(ex['label'][rrc[0]] if len(rrc) > 0 else self.L_NULL)
+                    l_features.append(label[lc[0]] if len(lc) > 0 else self.L_NULL)
+                    l_features.append(label[rc[0]] if len(rc) > 0 else self.L_NULL)
+                    l_features.append(label[lc[1]] if len(lc) > 1 else self.L_NULL)
+                    l_features.append(label[rc[1]] if len(rc) > 1 else self.L_NULL)
+                    l_features.append(label[llc[0]] if len(llc) > 0 else self.L_NULL)
+                    l_features.append(label[rrc[0]] if len(rrc) > 0 else self.L_NULL)
             else:
                 features += [self.NULL] * 6
                 if self.use_pos:
@@ -182,7 +272,7 @@ class Parser(object):
             if (i1 > 0) and (h1 == i0):
                 return 0
             elif (i1 >= 0) and (h0 == i1) and \
-                 (not any([x for x in buf if ex['head'][x] == i0])):
+                 (not any(ex['head'][x] == i0 for x in buf)):
                 return 1
             else:
                 return None if len(buf) == 0 else 2
@@ -190,7 +280,7 @@ class Parser(object):
             if (i1 > 0) and (h1 == i0):
                 return l1 if (l1 >= 0) and (l1 < self.n_deprel) else None
             elif (i1 >= 0) and (h0 == i1) and \
-                 (not any([x for x in buf if ex['head'][x] == i0])):
+                 (not any(ex['head'][x] == i0 for x in buf)):
                 return l0 + self.n_deprel if (l0 >= 0) and (l0 < self.n_deprel) else None
             else:
                 return None if len(buf) == 0 else self.n_trans - 1
@@ -235,17 +325,92 @@ class Parser(object):
         labels += [1] if len(buf) > 0 else [0]
         return labels
 
-    def parse(self, dataset, eval_batch_size=5000):
-        sentences = []
-        sentence_id_to_idx = {}
-        for i, example in enumerate(dataset):
-            n_words = len(example['word']) - 1
-            sentence = [j + 1 for j in range(n_words)]
-            sentences.append(sentence)
-            sentence_id_to_idx[id(sentence)] = i
+    def predict_dependencies(self, dataset, eval_batch_size=5000):
+        """Parses vectorized examples and returns their (head, dependent) lists.
+
+        If `self.parse_cache` is set, sentences whose (word ids, POS ids) were parsed before
+        by the same model are answered from the cache without building a PartialParse, and
+        repeats within `dataset` are parsed only once.
+        """
+        cache = self.parse_cache
+        if cache is None:
+            todo = list(range(len(dataset)))
+            dependencies = [None] * len(dataset)
+        else:
+            cache.check_model(self.model)
+            keys = [ParseCache.key(ex) for ex in dataset]
+            dependencies = [cache.get(k) for k in keys]
+            first = {}
+            for i, d in enumerate(dependencies):
+                if d is None:
+                    first.setdefault(keys[i], i)
+            todo = sorted(first.values())
+
+        fallback = self._decode(dataset, todo, dependencies, eval_batch_size)
 
-        model = ModelWrapper(self, dataset, sentence_id_to_idx)
-        dependencies = minibatch_parse(sentences, model, eval_batch_size)
+        if cache is not None:
+            for i in todo:
+                if i not in fallback:
+                    cache.put(keys[i], dependencies[i])
+            for i, d in enumerate(dependencies):
+                if d is None:
+                    dependencies[i] = list(dependencies[first[keys[i]]])
+                    cache.deduplicated += 1
+        return dependencies
+
+    def model_wrapper(self):
+        """The predict(partial_parses) adapter of minibatch_parse for `self.model`."""
+        from numpy_model import NumpyParserModel
+
+        if isinstance(self.model, NumpyParserModel):
+            return NumpyModelWrapper(self)
+        return ModelWrapper(self)
+
+    def _decode(self, dataset, todo, dependencies, eval_batch_size):
+        """Decodes dataset[i] for i in `todo` into `dependencies[i]`.
+
+        Sentences longer than `self.long_sentence_threshold` are decoded after the others, in
+        their own minibatches and under the long-sentence budgets, so a few outliers do not hold
+        up every other parse. Counts are accumulated in `self.decode_stats`.
+
+        @return fallback (set of int): indices completed right-branching because they ran over budget
+        """
+        threshold = self.long_sentence_threshold
+        if threshold is None:
+            queues = [(todo, eval_batch_size, {})]
+        else:
+            short = [i for i in todo if len(dataset[i]['word']) - 1 <= threshold]
+            long = [i for i in todo if len(dataset[i]['word']) - 1 > threshold]
+            queues = [(short, eval_batch_size, {}),
+                      (long, self.long_sentence_batch_size,
+                       {'max_steps': self.long_sentence_max_steps, 'time_budget': self.long_sentence_time_budget})]
+
+        fallback = set()
+        model = self.model_wrapper()
+        for q, (queue, batch_size, budget) in enumerate(queues):
+            if len(queue) == 0:
+                continue
+            start = time.time()
+            stats = {}
+            sentences = [[j + 1 for j in range(len(dataset[i]['word']) - 1)] for i in queue]
+            parsed = minibatch_parse(sentences, model, batch_size, examples=[dataset[i] for i in queue],
+                                     n_groups=self.pipeline_groups, stats=stats, **budget)
+            for i, deps in zip(queue, parsed):
+                dependencies[i] = deps
+            for k in stats['fallback']:
+                fallback.add(queue[k])
+                # A parse can run over budget before its first prediction normalized ROOT to 0.
+                dependencies[queue[k]] = [(0 if h == "ROOT" else h, t) for (h, t) in dependencies[queue[k]]]
+
+            self.decode_stats['sentences'] += len(queue)
+            if q == 1:
+                self.decode_stats['long_sentences'] += len(queue)
+                self.decode_stats['long_seconds'] += time.time() - start
+            self.decode_stats['fallbacks'] += len(stats['fallback'])
+        return fallback
+
+    def parse(self, dataset, eval_batch_size=5000):
+        dependencies = self.predict_dependencies(dataset, eval_batch_size)
 
         UAS = all_tokens = 0.0
         #with tqdm(total=len(dataset)) as prog:
@@ -265,55 +430,317 @@ class Parser(object):
         return UAS, dependencies
 
 
+class ParseCache(object):
+    """LRU cache of parses keyed by a sentence's (word ids, POS ids).
+
+    Entries are only valid for the model that produced them: `check_model` clears the
+    cache when a different model object is used or any of its parameters has been
+    modified in place (training steps, load_state_dict) since the entries were added.
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.model_version = None
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        # Cache misses answered by parsing an identical sentence of the same call.
+        self.deduplicated = 0
+
+    @staticmethod
+    def key(ex):
+        return tuple(ex['word']), tuple(ex['pos'])
+
+    @staticmethod
+    def version_of(model):
+        # NumpyParserModel arrays are read-only and have no version counter.
+        return id(model), tuple(getattr(p, '_version', 0) for p in model.parameters())
+
+    def check_model(self, model):
+        version = self.version_of(model)
+        if version != self.model_version:
+            if len(self.entries) > 0:
+                self.invalidations += 1
+            self.entries.clear()
+            self.model_version = version
+
+    def get(self, key):
+        deps = self.entries.get(key)
+        if deps is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return list(deps)
+
+    def put(self, key, deps):
+        self.entries[key] = tuple(deps)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hit_rate, 'deduplicated': self.deduplicated, 'evictions': self.evictions,
+                'invalidations': self.invalidations}
+
+
 class ModelWrapper(object):
-    def __init__(self, parser, dataset, sentence_id_to_idx):
+    """Adapts a Parser and its model to the predict(partial_parses) interface of minibatch_parse.
+
+    Each PartialParse must carry its vectorized example as `ex` (see Parser.parse).
+    Minibatches bound for an accelerator are staged in pinned buffers that are kept per
+    decoding thread and reused across steps.
+    """
+    def __init__(self, parser):
         self.parser = parser
-        self.dataset = dataset
-        self.sentence_id_to_idx = sentence_id_to_idx
+        self.staging = threading.local()
 
     def predict(self, partial_parses):
-        mb_x = [self.parser.extract_features(p.stack, p.buffer, p.dependencies,
-                                             self.dataset[self.sentence_id_to_idx[id(p.sentence)]])
-                for p in partial_parses]
-        mb_x = np.array(mb_x).astype('int32')
-        mb_x = torch.from_numpy(mb_x).long()
+        """Predicts the next transition for each partial parse.
+
+        Configurations whose legal-label mask allows a single transition (e.g. only SHIFT
+        while the stack holds just ROOT, or only RIGHT-ARC once the buffer is empty and two
+        items remain on the stack) are resolved directly from the mask; only the ambiguous
+        ones are featurized and scored by the model.
+        """
+        import numpy as np
+
         mb_l = [self.parser.legal_labels(p.stack, p.buffer) for p in partial_parses]
+        pred = [None] * len(partial_parses)
+        ambiguous = []
+        for i, (p, l) in enumerate(zip(partial_parses, mb_l)):
+            # extract_features maps the root placeholder to index 0; do the same here so
+            # parses that never reach the model still report head 0 for the root arc.
+            if p.stack[0] == "ROOT":
+                p.stack[0] = 0
+            if sum(l) == 1:
+                pred[i] = l.index(1)
+            else:
+                ambiguous.append(i)
+
+        if len(ambiguous) > 0:
+            mb_x = [self.parser.extract_features(p.stack, p.buffer, p.dependencies, p.ex)
+                    for p in (partial_parses[i] for i in ambiguous)]
+            mb_x = np.array(mb_x, dtype=np.int64)
+            mb_l = np.array([mb_l[i] for i in ambiguous], dtype=np.float32)
+            for i, p in zip(ambiguous, self.best_transitions(mb_x, mb_l)):
+                pred[i] = p
 
-        pred = self.parser.model.forward(mb_x)
-        pred = pred.detach().cpu().numpy()
-        pred = np.argmax(pred + 10000 * np.array(mb_l).astype('float32'), 1)
         pred = ["S" if p == 2 else ("LA" if p == 0 else "RA") for p in pred]
         return pred
 
+    def best_transitions(self, mb_x, mb_l):
+        """Returns the highest scoring legal transition for every row of the feature matrix
+        `mb_x` (n, n_features), given the legal-label mask `mb_l` (n, n_trans)."""
+        import torch
+
+        model = self.parser.model
+        buffers = getattr(self.staging, 'buffers', None)
+        if buffers is None:
+            buffers = self.staging.buffers = PinnedBuffers()
+        mb_x = to_device(torch.from_numpy(mb_x), model.device, buffers)
+        # The mask only selects scores, so it is sent as bool whatever the model's dtype.
+        illegal = to_device(torch.from_numpy(mb_l == 0), model.device, buffers)
+
+        # Grad mode is per thread, so disable it here rather than relying on the caller.
+        with torch.no_grad():
+            scores = model.forward(mb_x)
+            # Illegal transitions are masked with -inf: adding a large bonus to the legal ones
+            # instead rounds away float32 score differences below ~1e-3 (see differential_check.py).
+            return torch.argmax(scores.masked_fill(illegal, float('-inf')), 1).cpu().numpy()
+
+
+class NumpyModelWrapper(ModelWrapper):
+    """ModelWrapper for a parser whose model is a NumpyParserModel (see numpy_model.py);
+    decoding with it does not import torch."""
+    def best_transitions(self, mb_x, mb_l):
+        import numpy as np
+
+        scores = self.parser.model.forward(mb_x)
+        return np.argmax(np.where(mb_l == 0, -np.inf, scores), 1)
+
+
+class PinnedBuffers(object):
+    """Reusable pinned host buffers for copies to a CUDA device (see to_device).
+
+    One buffer is kept per dtype and row shape, grown to the largest number of rows staged so
+    far, so a loop copying similar minibatches allocates pinned memory only a few times. Before
+    a buffer is overwritten, the copy that last read from it is waited for. Not thread-safe:
+    use one instance per thread.
+    """
+    def __init__(self):
+        self.buffers = {}
+
+    def stage(self, x, device):
+        import torch
+
+        key = (x.dtype, tuple(x.shape[1:]))
+        buf, copied = self.buffers.get(key, (None, None))
+        if copied is not None:
+            copied.synchronize()
+        if buf is None or buf.shape[0] < x.shape[0]:
+            buf = torch.empty(tuple(x.shape), dtype=x.dtype, pin_memory=True)
+        staged = buf[:x.shape[0]]
+        staged.copy_(x)
+        out = staged.to(device, non_blocking=True)
+        copied = torch.cuda.Event()
+        copied.record()
+        self.buffers[key] = (buf, copied)
+        return out
+
+
+def to_device(x, device, buffers=None):
+    """Moves a CPU tensor to `device`, staging it in pinned memory so the copy to an
+    accelerator can run asynchronously. CPU tensors are returned as they are.
+
+    @param buffers (PinnedBuffers): pinned buffers to stage CUDA copies in; without them a
+                                    fresh pinned copy of `x` is made on every call
+    """
+    import torch
+
+    device = torch.device(device)
+    if device.type == 'cpu':
+        return x
+    if buffers is not None and device.type == 'cuda':
+        return buffers.stage(x, device)
+    return x.pin_memory().to(device, non_blocking=True)
+
+
+# Floating point types a model can be trained or loaded in (names of torch dtypes).
+DTYPES = ('float32', 'float16', 'bfloat16', 'float64')
+
+
+def torch_dtype(name):
+    """The torch dtype called `name` (one of DTYPES), or None for None (without importing torch)."""
+    if name is None:
+        return None
+    import torch
+
+    return getattr(torch, name)
+
 
 def read_conll(in_file, lowercase=False, max_example=None):
-    examples = []
     with open(in_file) as f:
-        word, pos, head, label = [], [], [], []
-        for line in f.readlines():
-            sp = line.strip().split('\t')
-            if len(sp) == 10:
-                if '-' not in sp[0]:
-                    word.append(sp[1].lower() if lowercase else sp[1])
-                    pos.append(sp[4])
-                    head.append(int(sp[6]))
-                    label.append(sp[7])
-            elif len(word) > 0:
-                examples.append({'word': word, 'pos': pos, 'head': head, 'label': label})
-                word, pos, head, label = [], [], [], []
-                if (max_example is not None) and (len(examples) == max_example):
-                    break
-        if len(word) > 0:
+        return read_conll_lines(f, lowercase, max_example)
+
+
+def read_conll_lines(lines, lowercase=False, max_example=None):
+    """Parses CoNLL lines (an open file or any iterable of lines) like read_conll. Lines are
+    consumed lazily, so with `max_example` only the start of a file is read."""
+    examples = []
+    word, pos, head, label = [], [], [], []
+    for line in lines:
+        sp = line.strip().split('\t')
+        if len(sp) == 10:
+            if '-' not in sp[0]:
+                word.append(sp[1].lower() if lowercase else sp[1])
+                pos.append(sp[4])
+                head.append(int(sp[6]))
+                label.append(sp[7])
+        elif len(word) > 0:
             examples.append({'word': word, 'pos': pos, 'head': head, 'label': label})
+            word, pos, head, label = [], [], [], []
+            if (max_example is not None) and (len(examples) == max_example):
+                break
+    if len(word) > 0:
+        examples.append({'word': word, 'pos': pos, 'head': head, 'label': label})
     return examples
 
 
-def build_dict(keys, n_max=None, offset=0):
-    count = Counter()
-    for key in keys:
-        count[key] += 1
-    ls = count.most_common() if n_max is None \
-        else count.most_common(n_max)
+def iter_conll(f, lowercase=False, tagged=False, tag_sep='/'):
+    """Streams sentences from an open CoNLL(-U) or tagged-text file.
+
+    Unlike read_conll, sentences are yielded one at a time together with the lines they
+    were read from, so a corpus can be parsed and written back without holding it in memory.
+    With `tagged`, every line is one sentence of whitespace-separated `word<tag_sep>TAG` tokens.
+
+    @yield (ex, lines): ex is a dict like those of read_conll (head/label are placeholders if
+                        the input has none); lines are the raw input lines of the sentence
+    """
+    if tagged:
+        for line in f:
+            tokens = [t.rsplit(tag_sep, 1) for t in line.split()]
+            if len(tokens) == 0:
+                continue
+            word = [t[0].lower() if lowercase else t[0] for t in tokens]
+            pos = [t[1] if len(t) > 1 else UNK for t in tokens]
+            ex = {'word': word, 'pos': pos, 'head': [-1] * len(word), 'label': ['_'] * len(word)}
+            yield ex, [t[0] for t in tokens]
+        return
+
+    word, pos, head, label, lines = [], [], [], [], []
+    for line in f:
+        sp = line.rstrip('\n').split('\t')
+        if len(sp) == 10:
+            lines.append(line)
+            if '-' not in sp[0] and '.' not in sp[0]:
+                word.append(sp[1].lower() if lowercase else sp[1])
+                pos.append(sp[4])
+                head.append(int(sp[6]) if sp[6].isdigit() else -1)
+                label.append(sp[7])
+        elif len(word) > 0:
+            yield {'word': word, 'pos': pos, 'head': head, 'label': label}, lines
+            word, pos, head, label, lines = [], [], [], [], []
+        elif line.startswith('#'):
+            lines.append(line)
+    if len(word) > 0:
+        yield {'word': word, 'pos': pos, 'head': head, 'label': label}, lines
+
+
+def write_conll(f, ex, lines, dependencies, tagged=False):
+    """Writes one parsed sentence in CoNLL-U format with predicted HEAD and DEPREL columns.
+
+    @param ex (dict): the sentence as yielded by iter_conll
+    @param lines (list of str): its input lines (or words, for tagged input)
+    @param dependencies (list of tuple): predicted (head, dependent) arcs, optionally with a
+                                         label as a third element; DEPREL is `_` otherwise
+    """
+    head = [0] * (len(ex['word']) + 1)
+    deprel = ['_'] * (len(ex['word']) + 1)
+    for arc in dependencies:
+        head[arc[1]] = arc[0]
+        if len(arc) > 2:
+            deprel[arc[1]] = arc[2]
+
+    if tagged:
+        for i, (w, p) in enumerate(zip(lines, ex['pos'])):
+            f.write('{}\t{}\t_\t_\t{}\t_\t{}\t{}\t_\t_\n'.format(i + 1, w, p, head[i + 1], deprel[i + 1]))
+    else:
+        i = 0
+        for line in lines:
+            sp = line.rstrip('\n').split('\t')
+            if len(sp) == 10 and '-' not in sp[0] and '.' not in sp[0]:
+                i += 1
+                sp[6], sp[7] = str(head[i]), deprel[i]
+                line = '\t'.join(sp) + '\n'
+            f.write(line)
+    f.write('\n')
+
+
+def build_dict(keys, n_max=None, offset=0, min_count=1, keep=None):
+    """Maps keys to ids in decreasing order of frequency.
+
+    @param keys (iterable or Counter): keys to count (a Counter is used as the counts directly)
+    @param n_max (int): keep only the `n_max` most frequent keys
+    @param offset (int): id of the most frequent key
+    @param min_count (int): drop keys seen fewer than `min_count` times
+    @param keep (container): keys exempt from the `min_count` cutoff
+    """
+    if isinstance(keys, Counter):
+        count = keys
+    else:
+        count = Counter()
+        for key in keys:
+            count[key] += 1
+    ls = [(w, c) for (w, c) in count.most_common()
+          if c >= min_count or (keep is not None and w in keep)]
+    if n_max is not None:
+        ls = ls[:n_max]
 
     return {w[0]: index + offset for (index, w) in enumerate(ls)}
 
@@ -338,43 +765,132 @@ def punct(language, pos):
         raise ValueError('language: %s is not supported.' % language)
 
 
-def minibatches(data, batch_size):
+def stratified_sample(dataset, n, n_buckets=10, seed=0):
+    """Draws a fixed subsample of `n` examples stratified by sentence length.
+
+    Examples are split into `n_buckets` equally sized length quantiles and each bucket
+    contributes in proportion to its size, so the subsample keeps the length profile
+    (and hence roughly the difficulty) of the full set. Original order is preserved.
+    """
+    import numpy as np
+
+    if n >= len(dataset):
+        return dataset
+    rng = np.random.RandomState(seed)
+    order = sorted(range(len(dataset)), key=lambda i: len(dataset[i]['word']))
+    buckets = np.array_split(np.array(order), n_buckets)
+    # Largest remainder allocation: every bucket gets the floor of its quota and the examples
+    # left over go to the buckets with the largest fractional parts, so exactly n are drawn.
+    quotas = [n * len(bucket) / float(len(dataset)) for bucket in buckets]
+    counts = [int(q) for q in quotas]
+    by_remainder = sorted(range(len(buckets)), key=lambda b: counts[b] - quotas[b])
+    for b in by_remainder[:n - sum(counts)]:
+        counts[b] += 1
+    chosen = []
+    for bucket, k in zip(buckets, counts):
+        chosen.extend(rng.choice(bucket, k, replace=False).tolist())
+    return [dataset[i] for i in sorted(chosen)]
+
+
+def minibatches(data, batch_size, rng=None):
+    import numpy as np
+    from . general_utils import get_minibatches
+
     x = np.array([d[0] for d in data])
     y = np.array([d[2] for d in data])
     one_hot = np.zeros((y.size, 3))
     one_hot[np.arange(y.size), y] = 1
-    return get_minibatches([x, one_hot], batch_size)
+    return get_minibatches([x, one_hot], batch_size, rng=rng)
 
 
-def load_and_preprocess_data(reduced=True):
-    config = Config()
+def set_seed(seed, deterministic=True, num_threads=None, device='cpu'):
+    """Seeds the python, numpy and torch RNGs for a reproducible run.
 
-    print("Loading data...",)
-    start = time.time()
-    train_set = read_conll(os.path.join(config.data_path, config.train_file),
-                           lowercase=config.lowercase)
-    dev_set = read_conll(os.path.join(config.data_path, config.dev_file),
-                         lowercase=config.lowercase)
-    test_set = read_conll(os.path.join(config.data_path, config.test_file),
-                          lowercase=config.lowercase)
-    if reduced:
-        train_set = train_set[:1000]
-        dev_set = dev_set[:500]
-        test_set = test_set[:500]
-    print("took {:.2f} seconds".format(time.time() - start))
-
-    print("Building parser...",)
-    start = time.time()
-    parser = Parser(train_set)
-    print("took {:.2f} seconds".format(time.time() - start))
-
-    print("Loading pretrained embeddings...",)
-    start = time.time()
+    With `deterministic`, torch.use_deterministic_algorithms is switched on. That flag is
+    process-wide and stays on after this returns, so everything else this process runs with
+    torch (later sweep settings, evaluation, parsing) also gets the deterministic kernels, which
+    can be slower on GPU; pass deterministic=False where speed matters more than bit-identical
+    runs. On CPU an op without a deterministic kernel raises; on CUDA it only warns, and cuBLAS
+    is given the fixed workspace it needs (CUBLAS_WORKSPACE_CONFIG, unless already set), so this
+    must be called before the first CUDA matrix product.
+
+    @param seed (int): seed for all three generators
+    @param deterministic (bool): also make torch use deterministic kernels
+    @param num_threads (int): fix the number of torch intra-op threads, so that reductions are
+                              split the same way from run to run
+    @param device (torch.device or str): device the run trains on
+    """
+    import numpy as np
+    import torch
+
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    if deterministic and hasattr(torch, 'use_deterministic_algorithms'):
+        if str(device).startswith('cuda'):
+            os.environ.setdefault('CUBLAS_WORKSPACE_CONFIG', ':4096:8')
+            try:
+                torch.use_deterministic_algorithms(True, warn_only=True)
+            except TypeError:
+                # torch < 1.11 has no warn_only; keep the nondeterministic kernels rather than fail.
+                pass
+        else:
+            torch.use_deterministic_algorithms(True)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+
+def check_deterministic_decoding(parser, dataset, batch_sizes=(1, 64, 5000), pipeline_groups=(1, 2),
+                                 num_threads=(1, 4)):
+    """Checks that decoding gives identical parses for every batch size, number of pipelined
+    decoding groups and number of torch threads.
+
+    Speed-oriented settings must not change parses; this reports the first setting that does.
+
+    @return passed (bool)
+    """
+    import torch
+
+    saved_groups, saved_threads, saved_cache = parser.pipeline_groups, torch.get_num_threads(), parser.parse_cache
+    parser.parse_cache = None
+    reference = None
+    passed = True
+    try:
+        for threads in num_threads:
+            torch.set_num_threads(threads)
+            for groups in pipeline_groups:
+                parser.pipeline_groups = groups
+                for batch_size in batch_sizes:
+                    dependencies = parser.predict_dependencies(dataset, batch_size)
+                    setting = "batch_size={}, pipeline_groups={}, threads={}".format(batch_size, groups, threads)
+                    if reference is None:
+                        reference, reference_setting = dependencies, setting
+                    elif dependencies != reference:
+                        i = next(i for i, (a, b) in enumerate(zip(dependencies, reference)) if a != b)
+                        print("Decoding with {} differs from {} first on sentence {}".format(
+                            setting, reference_setting, i))
+                        passed = False
+    finally:
+        parser.pipeline_groups, parser.parse_cache = saved_groups, saved_cache
+        torch.set_num_threads(saved_threads)
+    if passed:
+        print("Deterministic decoding check passed!")
+    return passed
+
+
+def read_word_vectors(path):
     word_vectors = {}
-    for line in open(config.embedding_file).readlines():
-        sp = line.strip().split()
-        word_vectors[sp[0]] = [float(x) for x in sp[1:]]
-    embeddings_matrix = np.asarray(np.random.normal(0, 0.9, (parser.n_tokens, 50)), dtype='float32')
+    with open(path) as f:
+        for line in f:
+            sp = line.strip().split()
+            word_vectors[sp[0]] = [float(x) for x in sp[1:]]
+    return word_vectors
+
+
+def build_embedding_matrix(parser, word_vectors, rng):
+    import numpy as np
+
+    embeddings_matrix = np.asarray(rng.normal(0, 0.9, (parser.n_tokens, 50)), dtype='float32')
 
     for token in parser.tok2id:
         i = parser.tok2id[token]
@@ -382,21 +898,242 @@ def load_and_preprocess_data(reduced=True):
             embeddings_matrix[i] = word_vectors[token]
         elif token.lower() in word_vectors:
             embeddings_matrix[i] = word_vectors[token.lower()]
-    print("took {:.2f} seconds".format(time.time() - start))
+    return embeddings_matrix
+
+
+def _call_in(executor, fn, *args, **kwargs):
+    """Runs fn in `executor` (if any) and waits for its result; used to move a pure stage of
+    the loader out of the calling process."""
+    if executor is None:
+        return fn(*args, **kwargs)
+    return executor.submit(fn, *args, **kwargs).result()
+
+
+def load_and_preprocess_data(reduced=True, seed=None):
+    """Reads the data and embeddings, builds the Parser and the training instances.
+
+    The loading stages form a dependency graph (the three CoNLL files and the embedding file
+    are read independently, dev/test vectorization does not wait for instance creation, ...)
+    and are run by `run_stages`, so independent stages overlap. With `Config.load_processes`,
+    the file-reading stages run in worker processes so they also overlap in CPU time despite
+    the GIL. A per-stage timing breakdown is printed at the end.
+    """
+    import numpy as np
+    from .general_utils import run_stages
+
+    config = Config()
+    rng = np.random if seed is None else np.random.RandomState(seed)
 
-    print("Vectorizing data...",)
-    start = time.time()
-    train_set = parser.vectorize(train_set)
-    dev_set = parser.vectorize(dev_set)
-    test_set = parser.vectorize(test_set)
-    print("took {:.2f} seconds".format(time.time() - start))
+    executor = None
+    if config.load_processes:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=config.load_workers)
 
-    print("Preprocessing training data...",)
-    start = time.time()
-    train_examples = parser.create_instances(train_set)
-    print("took {:.2f} seconds".format(time.time() - start))
+    # In reduced mode only the start of each file is read.
+    def read(file_name, max_example):
+        return lambda: _call_in(executor, read_conll, os.path.join(config.data_path, file_name),
+                                lowercase=config.lowercase, max_example=max_example if reduced else None)
 
-    return parser, embeddings_matrix, train_examples, dev_set, test_set,
+    def create_instances(parser, raw_train_set, train_set):
+        if config.instance_store is None:
+            return parser.create_instances(train_set)
+        from .instance_store import InstanceStore
+        store = InstanceStore(config.instance_store)
+        keys = store.update(parser, raw_train_set, train_set)
+        return store.instances(parser, keys, train_set)
+
+    stages = {
+        'read train': (read(config.train_file, 1000), []),
+        'read dev': (read(config.dev_file, 500), []),
+        'read test': (read(config.test_file, 500), []),
+        'read embeddings': (lambda: _call_in(executor, read_word_vectors, config.embedding_file), []),
+        'build parser': (lambda train_set, word_vectors: Parser(train_set, pretrained_vocab=word_vectors),
+                         ['read train', 'read embeddings']),
+        'embedding matrix': (lambda parser, word_vectors: build_embedding_matrix(parser, word_vectors, rng),
+                             ['build parser', 'read embeddings']),
+        'vectorize train': (lambda parser, data: parser.vectorize(data), ['build parser', 'read train']),
+        'vectorize dev': (lambda parser, data: parser.vectorize(data), ['build parser', 'read dev']),
+        'vectorize test': (lambda parser, data: parser.vectorize(data), ['build parser', 'read test']),
+        'create instances': (create_instances, ['build parser', 'read train', 'vectorize train']),
+    }
+    print("Loading data...",)
+    try:
+        results, timings = run_stages(stages, max_workers=config.load_workers)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    wall = max(end for (_, end) in timings.values())
+    print("took {:.2f} seconds ({:.2f} seconds of stages)".format(
+        wall, sum(end - begin for (begin, end) in timings.values())))
+    for name, (begin, end) in sorted(timings.items(), key=lambda t: t[1]):
+        print("  {:<18} {:>6.2f} - {:>6.2f}  ({:.2f} seconds)".format(name, begin, end, end - begin))
+
+    return results['build parser'], results['embedding matrix'], results['create instances'], \
+        results['vectorize dev'], results['vectorize test'],
+
+
+def export_compact_model(parser, output_dir, n_max=None, min_count=1, keep=None):
+    """Prunes the word vocabulary of a trained parser and writes a compacted bundle.
+
+    The pruning is done on a copy: `parser` and its model are left unchanged. The embedding
+    rows of the model are remapped to the pruned ids (see Parser.prune_vocabulary). Writes
+    `parser.pkl` (the pruned Parser without its model) and `model.weights` (the compacted
+    state dict) to `output_dir`.
+
+    @return index (ndarray): old token id for every row of the compacted table
+    """
+    import torch
+
+    compact_parser = copy.copy(parser)
+    compact_parser.model, compact_parser.parse_cache = None, None
+    compact_parser = copy.deepcopy(compact_parser)
+    index = compact_parser.prune_vocabulary(n_max=n_max, min_count=min_count, keep=keep)
+    state = dict(parser.model.state_dict())
+    state['embeddings'] = state['embeddings'].index_select(0, torch.from_numpy(index).to(state['embeddings'].device))
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    save_parser(compact_parser, os.path.join(output_dir, 'parser.pkl'))
+    torch.save(state, os.path.join(output_dir, 'model.weights'))
+    return index
+
+
+def export_numpy_model(parser, output_dir):
+    """Writes the parser and its model's weights as .npy arrays for NumpyParserModel.
+
+    Writes `parser.pkl` (the Parser without its model), `embeddings.npy`,
+    `embed_to_hidden_weight.npy`, `hidden_to_logits_weight.npy` and, for a
+    StudentParserModel, `feature_idx.npy` to `output_dir`. Weights are stored as float32.
+    """
+    import numpy as np
+
+    from numpy_model import WEIGHT_NAMES
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    save_parser(parser, os.path.join(output_dir, 'parser.pkl'))
+    state = parser.model.state_dict()
+    for name in WEIGHT_NAMES:
+        np.save(os.path.join(output_dir, name + '.npy'), state[name].detach().cpu().float().numpy())
+    if 'feature_idx' in state:
+        np.save(os.path.join(output_dir, 'feature_idx.npy'), state['feature_idx'].cpu().numpy())
+
+
+def load_numpy_parser(model_dir, mmap=True):
+    """Loads a Parser and NumpyParserModel exported by `export_numpy_model`; does not import torch."""
+    from numpy_model import NumpyParserModel
+
+    with open(os.path.join(model_dir, 'parser.pkl'), 'rb') as f:
+        parser = pickle.load(f)
+    parser.model = NumpyParserModel.load(model_dir, mmap=mmap)
+    return parser
+
+
+def load_model_dir(model_dir, device='cpu', mmap=False, dtype=None):
+    """Loads a parser from a directory written by training (parser.pkl and model.weights) or
+    by `export_numpy_model` (parser.pkl and .npy arrays, loaded without torch and always
+    memory-mapped, in float32). `mmap` memory-maps model.weights and `dtype` casts it (see
+    load_parser)."""
+    if not os.path.exists(os.path.join(model_dir, 'model.weights')) and \
+            os.path.exists(os.path.join(model_dir, 'embeddings.npy')):
+        return load_numpy_parser(model_dir)
+    return load_parser(os.path.join(model_dir, 'parser.pkl'), os.path.join(model_dir, 'model.weights'),
+                       device=device, mmap=mmap, dtype=dtype)
+
+
+def check_numpy_model(parser, numpy_parser, dataset, batch_size=5000, atol=1e-4):
+    """Checks that `numpy_parser` decodes `dataset` like the torch model of `parser`.
+
+    The logits of both models are compared on the feature matrices of the gold derivations
+    of `dataset`, and both parsers must predict the same dependencies for every sentence.
+
+    @return ok (bool): whether the logits agree within `atol` and all parses are identical
+    """
+    import numpy as np
+    import torch
+
+    instances = parser.create_instances(dataset)
+    max_diff = 0.
+    parser.model.eval()
+    for start in range(0, len(instances), batch_size):
+        x = np.array([inst[0] for inst in instances[start:start + batch_size]], dtype=np.int64)
+        with torch.no_grad():
+            expected = parser.model(to_device(torch.from_numpy(x), parser.model.device)).cpu().float().numpy()
+        max_diff = max(max_diff, float(np.abs(numpy_parser.model.forward(x) - expected).max()))
+    with torch.no_grad():
+        expected = parser.predict_dependencies(dataset, batch_size)
+    got = numpy_parser.predict_dependencies(dataset, batch_size)
+    mismatches = [i for i, (a, b) in enumerate(zip(expected, got)) if a != b]
+    print("numpy model: max |logit difference| {:.2e} over {} configurations, {} / {} sentences parsed "
+          "differently".format(max_diff, len(instances), len(mismatches), len(dataset)))
+    if len(mismatches) > 0:
+        print("first mismatch: sentence {}".format(mismatches[0]))
+    return max_diff <= atol and len(mismatches) == 0
+
+
+def save_parser(parser, path):
+    """Pickles the Parser's vocabularies and settings, without its model or parse cache."""
+    parser = copy.copy(parser)
+    parser.model = None
+    if parser.parse_cache is not None:
+        parser.parse_cache = ParseCache(parser.parse_cache.max_size)
+    with open(path, 'wb') as f:
+        pickle.dump(parser, f)
+
+
+def load_parser(parser_path, weights_path, device='cpu', mmap=False, dtype=None):
+    """Loads a Parser written by `save_parser` together with model weights onto `device`.
+
+    The model architecture (embedding table size, hidden size, student feature subset)
+    is taken from the shapes in the state dict, and its floating point type from `dtype`
+    (a torch.dtype), by default the type the weights were saved in.
+
+    With `mmap`, the parameters are views of the memory-mapped weights file instead of
+    copies: the operating system loads pages on first use and shares them between every
+    process that maps the same file, so N parse workers hold one copy of the embedding
+    table. The model is then inference-only (parameters do not require grad) and must
+    stay on the CPU.
+    """
+    import numpy as np
+    import torch
+
+    from parser_model import ParserModel, StudentParserModel
+
+    if mmap and torch.device(device).type != 'cpu':
+        raise ValueError("memory-mapped weights can only be used on the cpu, not {}".format(device))
+    if mmap and 'mmap' not in inspect.signature(torch.load).parameters:
+        raise RuntimeError("memory-mapped weights need torch >= 2.1 (torch.load(mmap=True) and "
+                           "load_state_dict(assign=True)); this is torch {}".format(torch.__version__))
+    with open(parser_path, 'rb') as f:
+        parser = pickle.load(f)
+    if mmap:
+        state = torch.load(weights_path, map_location='cpu', mmap=True)
+    else:
+        state = torch.load(weights_path, map_location='cpu')
+    saved_dtype = state['embeddings'].dtype
+    dtype = saved_dtype if dtype is None else dtype
+    if mmap and dtype != saved_dtype:
+        raise ValueError("memory-mapped weights are used as saved ({}); casting them to {} needs a copy, "
+                         "so load without mmap".format(saved_dtype, dtype))
+    embeddings = np.zeros(tuple(state['embeddings'].shape), dtype=np.float32)
+    hidden_size = state['embed_to_hidden_weight'].shape[1]
+    # A mapped model's parameters are replaced by the file's tensors, so build it without storage.
+    build_device = 'meta' if mmap else device
+    if 'feature_idx' in state:
+        model = StudentParserModel(embeddings, state['feature_idx'].tolist(), hidden_size=hidden_size,
+                                   device=build_device, dtype=dtype)
+    else:
+        model = ParserModel(embeddings, n_features=parser.n_features, hidden_size=hidden_size,
+                            device=build_device, dtype=dtype)
+    if mmap:
+        model.load_state_dict(state, assign=True)
+        model.requires_grad_(False)
+    else:
+        model.load_state_dict(state)
+    model.eval()
+    parser.model = model
+    return parser
 
 
 class AverageMeter(object):